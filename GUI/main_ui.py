@@ -1,41 +1,98 @@
+import json
+import logging
+import os
+import secrets
+import select
+import socket
+import time
 from flask import *
 from data.database import *
+from data.metrics import REGISTRY, track_request
+from data.query_budget import QueryBudget
 from data.db_utils import *
-from NLP.parser import process
+from NLP.batch import process_many
+from NLP.parser import process, ParserRegistry
+from NLP.template_cache import TemplateCache
+from NLP.value_recognizer import get_value_recognizer
 
 app = Flask(__name__)
 
+logger = logging.getLogger(__name__)
+
 class MainGUI:
-    def __init__(self, parser):
-        self.parser = parser
-        self.dbs = None
-        self.tables = None
-        self.current_db = None
+    def __init__(self, parsers=None, templates=None, slow_log=None):
+        self.parsers = parsers if parsers is not None else ParserRegistry()
+        self.templates = templates if templates is not None else TemplateCache()
+        self.slow_log = slow_log
+
+        # Set before any worker is forked so every worker accepts the same session cookies
+        app.secret_key = os.environ.get("NATURALSQL_SECRET_KEY") or app.secret_key or secrets.token_hex(32)
 
         app.add_url_rule('/', 'index', self.index)
         app.add_url_rule('/query', 'taking_question', self.taking_question, methods=['GET', 'POST'])
+        app.add_url_rule('/query/stream', 'stream_question', self.stream_question, methods=['POST'])
+        app.add_url_rule('/batch', 'batch_question', self.batch_question, methods=['POST'])
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
         
-    def run_ui(self):
-        app.run(port=5000)
+    def run_ui(self, host="127.0.0.1", port=5000, workers=1):
+        """
+        Start the web server
 
+        Arguments:
+            host (string): Address to listen on
+            port (int): Port to listen on
+            workers (int): Number of pre-forked worker processes. With 1 the
+                           Flask development server is used
+        """
+        if workers > 1:
+            from GUI.server import serve
+            serve(app, host, port, workers)
+        else:
+            app.run(host=host, port=port)
 
-    def index(self):
+    def selection(self, data=None):
         """
-        Display the homepage
+        Get the database and table this request is about: the ones sent
+        with the request, else the ones remembered in the user's session,
+        else the first database. A database that isn't listed, or a table
+        that database doesn't have, is never used
+
+        Argument:
+            data (dict): Request data, the submitted form by default
+
+        Returns:
+            db (string): Name of the database file
+            table (string): Name of the table, or "" for the whole database
         """
-        self.dbs = get_available_dbs()
+        data = request.form if data is None else data
+        dbs = get_available_dbs()
 
-        self.current_db = session.get('db', self.dbs[0])
-        path = DB_DIR + "/" + self.current_db
-        schema = get_schema_info(path)
+        db = data.get('database') or session.get('db')
+        if db not in dbs:
+            db = dbs[0]
 
-        self.tables = list(schema.keys())
+        # The table in the session was chosen in another database once the user switches
+        table = data.get('table')
+        if table is None and db == session.get('db'):
+            table = session.get('table', "")
+
+        # The table ends up in the FROM clause, only the ones of the database are accepted
+        if table not in SCHEMA_CATALOG.get(get_db_path(db)).tables:
+            table = ""
+
+        return db, table
+
+    def index(self):
+        """
+        Display the homepage
+        """
+        db, table = self.selection()
 
         return render_template('index.html',
-                               available_dbs = self.dbs,
-                               available_tables = self.tables,
-                               selected_db = self.current_db,
-                               selected_table = request.form.get('table'))
+                               available_dbs = get_available_dbs(),
+                               available_tables = list(get_schema_info(get_db_path(db)).keys()),
+                               selected_db = db,
+                               selected_table = table)
 
 
     def taking_question(self):
@@ -46,40 +103,220 @@ class MainGUI:
             return redirect(url_for('index'))
 
         user_input = request.form.get('user_input')
+        recognize_values = option_enabled(request.form.get('recognize_values'))
         sql_results = ""
         query = ""
+        params = ()
+
+        db, table = self.selection()
+        session['db'] = db
+        session['table'] = table
 
         if user_input:
-            print("--------")
-            print(user_input)
-            print("--------")
-            query = process(user_input, self.parser)
-            
-            if query:
-                path = DB_DIR + "/" + self.current_db
-                query, sql_results = execute_query(query, path)
-            else:
-                query = "Invalid input"
+            logger.info("Question: %s", user_input)
+            path = get_db_path(db)
+
+            with track_request("query") as metrics:
+                # Use the parser built for the database and table selected in the UI
+                parser = self.parsers.get(path, table)
+                recognizer = get_value_recognizer(path, table) if recognize_values else None
+                query, params = process(user_input, parser, table, path, parse_mode="first",
+                                        templates=self.templates, parameterize=True, recognizer=recognizer)
+
+                if query:
+                    budget = QueryBudget(is_cancelled=client_disconnected(request.environ))
+                    query, sql_results = execute_query(query, path, params, budget)
+                else:
+                    query = "Invalid input"
+            self.finish_request(metrics, path)
 
         return render_template(
             'index.html',
             user_input = user_input,
             query = query,
+            params = params,
             sql_results = sql_results,
-            available_dbs = self.dbs,
-            available_tables = self.tables,
-            selected_db = self.current_db,
-            selected_table = request.form.get('table')
+            available_dbs = get_available_dbs(),
+            available_tables = list(get_schema_info(get_db_path(db)).keys()),
+            selected_db = db,
+            selected_table = table,
+            recognize_values = recognize_values
         )
     
+    def stream_question(self):
+        """
+        Takes the user input and streams the query results back in chunks
+        as an HTML table, or JSON if `format` is "json". `max_rows` can
+        lower the number of rows sent, never raise it above STREAM_MAX_ROWS.
+        Unquoted values are recognised if `recognize_values` is set
+        """
+        user_input = request.form.get('user_input')
+        recognize_values = option_enabled(request.form.get('recognize_values'))
+        db, table = self.selection()
+        fmt = request.form.get('format', 'html')
+        try:
+            max_rows = int(request.form.get('max_rows', STREAM_MAX_ROWS))
+        except ValueError:
+            return jsonify({'error': "Expected a number of rows"}), 400
+        if max_rows < 1:
+            return jsonify({'error': "Expected a positive number of rows"}), 400
+        max_rows = min(max_rows, STREAM_MAX_ROWS)
+        path = get_db_path(db)
+
+        query, params = "", ()
+        if user_input:
+            with track_request("stream") as metrics:
+                parser = self.parsers.get(path, table)
+                recognizer = get_value_recognizer(path, table) if recognize_values else None
+                query, params = process(user_input, parser, table, path, parse_mode="first",
+                                        templates=self.templates, parameterize=True, recognizer=recognizer)
+        if not query:
+            if user_input:
+                self.finish_request(metrics, path)
+            return jsonify({'error': "Invalid input"}), 400
+
+        mimetype = "application/json" if fmt == "json" else "text/html"
+        budget = QueryBudget(row_limit=max_rows, is_cancelled=client_disconnected(request.environ))
+        chunks = stream_query(query, path, params, fmt, max_rows=max_rows, budget=budget)
+        return Response(stream_with_context(self.streamed(chunks, metrics, path)), mimetype=mimetype)
+
+    def streamed(self, chunks, metrics, path):
+        """
+        Pass the chunks of a streamed response through and log the request
+        once they are all sent, counting the streaming as its execute stage
+
+        Arguments:
+            chunks (generator): Chunks of the response
+            metrics (RequestMetrics): Metrics of the request
+            path (string): Path to the database the request was about
+
+        Yields:
+            string: The chunks
+        """
+        began = time.perf_counter()
+        try:
+            yield from chunks
+        finally:
+            ended = time.perf_counter()
+            metrics.stages["execute"] = metrics.stages.get("execute", 0.0) + ended - began
+            metrics.seconds = ended - metrics.started
+            self.finish_request(metrics, path)
+
+    def finish_request(self, metrics, path):
+        """
+        Log a finished request, and write it to the slow-query log if it was slow
+
+        Arguments:
+            metrics (RequestMetrics): Metrics of the request
+            path (string): Path to the database the request was about
+        """
+        log_request(metrics)
+        if self.slow_log is not None:
+            self.slow_log.check(metrics, path)
+
+    def batch_question(self):
+        """
+        Translates a JSON list of sentences in one request.
+        Expects {"sentences": [...]} with optional "database", "table",
+        "workers" (at most one per CPU) and "recognize_values", and returns
+        the query, parameters and error of each sentence in order
+        """
+        data = request.get_json(silent=True) or {}
+        sentences = data.get('sentences')
+        if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+            return jsonify({'error': "Expected a list of sentences"}), 400
+
+        workers = data.get('workers')
+        if workers is not None:
+            try:
+                workers = int(workers)
+            except (TypeError, ValueError):
+                workers = 0
+            if workers < 1:
+                return jsonify({'error': "Expected a positive number of workers"}), 400
+            # Never fork more processes than there are CPUs from the server
+            workers = min(workers, os.cpu_count() or 1)
+
+        db, table = self.selection(data)
+        path = get_db_path(db)
+        recognize_values = option_enabled(data.get('recognize_values'))
+
+        with track_request("batch") as metrics:
+            results = process_many(sentences, workers, path, table, parse_mode="first",
+                                    parameterize=True, recognize_values=recognize_values,
+                                    parser=self.parsers.get(path, table))
+        log_request(metrics)
+        return jsonify({'results': results})
+
+    def metrics(self):
+        """
+        Expose the stage timings, request latencies and cache and failure
+        counters of this process in the Prometheus text format
+        """
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
     @app.route("/get_tables/<db>")
     def get_tables(db):
         try:
-            schema = get_schema_info(db)
+            schema = get_schema_info(get_db_path(db))
             tables = list(schema.keys())
 
             return jsonify({'tables': tables})
 
-        except Exception as e:
-            print(e)
-            return
\ No newline at end of file
+        except Exception:
+            logger.exception("Could not list the tables of %s", db)
+            return
+
+
+def client_disconnected(environ):
+    """
+    Make a check of whether the client of a request hung up, so that a
+    query nobody is waiting for anymore can be stopped
+
+    Argument:
+        environ (dict): WSGI environment of the request
+
+    Returns:
+        callable: Returns True once the client closed the connection.
+                  None if the server doesn't expose the client socket
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return None
+
+    def check():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # A readable socket with nothing to read was closed by the client
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+        except ValueError:
+            # TLS sockets can't be peeked at, assume the client is still there
+            return False
+        except OSError:
+            return True
+
+    return check
+
+
+def option_enabled(value):
+    """
+    Tell whether an option sent with a request is turned on
+
+    Argument:
+        value: Value of the option in the form or JSON body, None if it wasn't sent
+
+    Returns:
+        bool: True for true, 1, "true", "on" and "yes"
+    """
+    return str(value).lower() in ("1", "true", "on", "yes")
+
+
+def log_request(metrics):
+    """
+    Log the stage timings of a request as one JSON line
+
+    Argument:
+        metrics (RequestMetrics): The metrics of the request
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Request %s", json.dumps(metrics.as_dict(), default=str))
@@ -0,0 +1,87 @@
+import gc
+import logging
+import os
+import signal
+import time
+from werkzeug.serving import make_server
+
+# Seconds to wait before replacing a worker that died, so a worker that
+# crashes on start doesn't get restarted in a tight loop
+RESPAWN_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def serve(app, host="127.0.0.1", port=5000, workers=2, threaded=True):
+    """
+    Serve the app from pre-forked worker processes. The listening socket
+    is opened once and shared, and the kernel hands each connection to
+    whichever worker accepts it first. Everything loaded before this is
+    called (parsers, vocabularies, NLTK data) is shared with the workers
+    copy-on-write instead of being built again in each of them
+
+    Arguments:
+        app (Flask): The app to serve
+        host (string): Address to listen on
+        port (int): Port to listen on
+        workers (int): Number of worker processes
+        threaded (bool): Let each worker handle requests in threads too
+    """
+    if not hasattr(os, "fork"):
+        logger.warning("Pre-forked workers need os.fork, serving from a single process")
+        app.run(host=host, port=port, threaded=threaded)
+        return
+
+    server = make_server(host, port, app, threaded=threaded)
+
+    # Keep the garbage collector of the workers from touching the objects
+    # built so far, which would copy the pages they live on
+    gc.collect()
+    gc.freeze()
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for _ in range(workers):
+        spawn()
+    logger.info("Serving on http://%s:%d with %d workers", host, server.server_port, workers)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        children.discard(pid)
+        if not stopping:
+            logger.warning("Worker %d exited with status %d, starting a new one", pid, status)
+            time.sleep(RESPAWN_DELAY)
+            if not stopping:
+                spawn()
+
+    server.server_close()
@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+from NLP.parser import init_parser, process
+from NLP.value_recognizer import get_value_recognizer
+from NLP.vocabulary import get_vocabulary
+from data.database import DB_PATH
+
+# Sentences sent to a worker at a time
+BATCH_CHUNK_SIZE = 64
+
+# Below this many distinct sentences a batch is translated in-process,
+# starting workers would take longer than the work itself
+BATCH_MIN_POOL_SIZE = 256
+
+# How pool workers are started. Forking the server would copy the locks its
+# other threads hold at that moment, which then never get released in the
+# child, so workers start from a clean process instead
+BATCH_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# State of a pool worker process, set up once by _init_worker. Batches
+# translated in the calling process keep theirs local, as several requests
+# may be translating at once in the threads of the server
+_worker = {}
+
+
+def process_many(sentences, workers=None, db_path=DB_PATH, table="", parse_mode="first", parameterize=False,
+                 recognize_values=False, parser=None, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Translate many sentences at once. Repeated sentences are translated
+    only once and the work is spread over a pool of processes, each of
+    which builds the parser and vocabulary once when it starts
+
+    Arguments:
+        sentences (list): Sentences written in natural language
+        workers (int): Number of worker processes, None for one per CPU.
+                       With 1 worker, or a small batch, the sentences are
+                       translated in this process
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+        parse_mode (string): "all", "first" or "segments", see process
+        parameterize (bool): If True, queries use ? placeholders
+        recognize_values (bool): If True, values written without quotes are recognised
+        parser (ChartParser): Parser to use when translating in this process
+        chunk_size (int): Number of sentences sent to a worker at a time
+
+    Returns:
+        list: One dict per sentence, in input order, with the sentence, its
+              query ("" if it couldn't be translated), the query parameters
+              and an error message or None
+    """
+    sentences = list(sentences)
+    unique = list(dict.fromkeys(sentences))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, -(-len(unique) // chunk_size)))
+
+    settings = (db_path, table, parse_mode, parameterize, recognize_values)
+    if workers == 1 or len(unique) < BATCH_MIN_POOL_SIZE:
+        state = _worker_state(*settings, parser=parser)
+        translated = [_translate(sentence, state) for sentence in unique]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunks = [unique[idx:idx + chunk_size] for idx in range(0, len(unique), chunk_size)]
+        context = multiprocessing.get_context(BATCH_START_METHOD)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=settings) as executor:
+            translated = [result for chunk in executor.map(_translate_chunk, chunks) for result in chunk]
+
+    results = dict(zip(unique, translated))
+    return [_result(sentence, *results[sentence]) for sentence in sentences]
+
+
+def _init_worker(db_path, table, parse_mode, parameterize, recognize_values):
+    _worker.update(_worker_state(db_path, table, parse_mode, parameterize, recognize_values))
+
+
+def _worker_state(db_path, table, parse_mode, parameterize, recognize_values, parser=None):
+    get_vocabulary(db_path, table)
+    return dict(
+        db_path=db_path,
+        table=table,
+        parse_mode=parse_mode,
+        parameterize=parameterize,
+        parser=parser if parser is not None else init_parser(db_path, table),
+        recognizer=get_value_recognizer(db_path, table) if recognize_values else None,
+    )
+
+
+def _translate_chunk(sentences):
+    return [_translate(sentence) for sentence in sentences]
+
+
+def _translate(sentence, state=None):
+    """
+    Translate one sentence with the parser of this worker
+
+    Arguments:
+        sentence (string): A sentence written in natural language
+        state (dict): Parser and settings to use, the ones of this worker if None
+
+    Returns:
+        tuple: The query, its parameters and an error message or None
+    """
+    if state is None:
+        state = _worker
+
+    try:
+        result = process(sentence, state["parser"], state["table"], state["db_path"],
+                         parse_mode=state["parse_mode"], parameterize=state["parameterize"],
+                         recognizer=state["recognizer"])
+    except Exception as e:
+        return "", (), f"{type(e).__name__}: {e}"
+
+    query, params = result if state["parameterize"] else (result, ())
+    if not query:
+        return "", (), "Could not translate the sentence"
+
+    return query, tuple(params), None
+
+
+def _result(sentence, query, params, error):
+    return {"sentence": sentence, "query": query, "params": list(params), "error": error}
@@ -21,7 +21,9 @@ AllStatement -> All | All P Det TableRef | All P TableRef | Det All TableRef | V
 
 FilterStatement -> FilterClause | FilterClause Conj FilterClause 
 FilterClause -> Filter | Filter NP | Filter DetCol IsVal | DetCol IsVal | Filter DetCol IsNum | DetCol IsNum
+FilterClause -> Filter DetCol ContainsVal | DetCol ContainsVal
 IsVal -> V ValPlaceholder | ValPlaceholder
+ContainsVal -> Contain ValPlaceholder | V Contain ValPlaceholder
 IsNum -> V NumPlaceholder | NumPlaceholder
 
 OrderClause -> Order OrderP DetCol | Order OrderP DetCol OrderDir | Order OrderP DetCol OrderDir  
@@ -40,6 +42,7 @@ V -> "show" | "list" | "give" | "what" | "let" | "see" | "who" | "is"
 
 All -> "everything" | "all" | "entire"
 Filter -> "where" | "with" | "for"
+Contain -> "containing" | "contains" | "contain" | "including" | "includes" | "include"
 
 ValPlaceholder -> "__value__"
 NumPlaceholder -> "__num__"
@@ -61,6 +64,7 @@ VALID_VOCABULARY = {
 
         'All': ["everything", "all", "entire"],
         'Filter' : ["where", "with", "for"],
+        'Contain' : ["containing", "contains", "contain", "including", "includes", "include"],
         'ValPlaceholder' : ["__value__"],
         'NumPlaceholder' : ["__num__"],
 
@@ -69,4 +73,18 @@ VALID_VOCABULARY = {
         'OrderP': ["by", "from", "in"],
 
         'Limit': ["best", "top", "worst", "bottom", "limit", "just"]
-}
\ No newline at end of file
+}
+# Long sentences can be split into a head and clauses that are parsed on
+# their own. Each clause starts at a word of one of these categories and is
+# parsed with the nonterminal it maps to as start symbol
+CLAUSE_KEYWORDS = {
+        'Filter': "FilterStatement",
+        'Order': "OrderClause",
+        'Limit': "LimitClause"
+}
+
+# Start symbol of the words before the first clause, and what they can be
+SEGMENT_HEAD = "Head"
+SEGMENT_HEAD_RULES = """
+Head -> VP NP | VP | AllStatement
+"""
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from data.metrics import CACHE_HITS, CACHE_MISSES
+
+# Directory compiled parsers are kept in. Files are only read back by this
+# module, so it must not be writable by anyone the server doesn't trust
+GRAMMAR_CACHE_DIR = os.environ.get("NATURALSQL_CACHE_DIR", ".cache/grammars")
+
+# Number of compiled parsers kept on disk, the least recently used are removed
+GRAMMAR_CACHE_FILES = 32
+
+# Bumped whenever the way parsers are built changes, so old files are ignored
+GRAMMAR_CACHE_FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+def grammar_text_key(text):
+    """
+    Get the name a compiled grammar is stored under. The grammar text holds
+    the table and column names, so a change of schema gives a new key
+
+    Argument:
+        text (string): Text of the grammar
+
+    Returns:
+        string: Hash of the grammar, the nltk and Python versions and the cache format
+    """
+    import nltk
+
+    digest = hashlib.sha256()
+    digest.update(f"{GRAMMAR_CACHE_FORMAT}\n{nltk.__version__}\n{sys.version_info[:2]}\n".encode())
+    digest.update(text.encode())
+    return digest.hexdigest()
+
+
+def load_parser(text, cache_dir=GRAMMAR_CACHE_DIR):
+    """
+    Get a chart parser for a grammar, loading it already compiled from the
+    cache directory when it was built before, and building and storing it
+    otherwise. Unpickling skips parsing the grammar text and building its
+    production and left-corner indexes
+
+    Arguments:
+        text (string): Text of the grammar
+        cache_dir (string): Directory of the cache, or None to always build the parser
+
+    Returns:
+        ChartParser: Parser for the grammar
+    """
+    import nltk
+
+    if not cache_dir:
+        return nltk.ChartParser(nltk.CFG.fromstring(text))
+
+    path = os.path.join(cache_dir, grammar_text_key(text) + ".pickle")
+    try:
+        with open(path, "rb") as f:
+            parser = pickle.load(f)
+        os.utime(path)
+        CACHE_HITS.inc("grammar")
+        return parser
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.warning("Ignoring unreadable compiled grammar %s", path, exc_info=True)
+
+    CACHE_MISSES.inc("grammar")
+    parser = nltk.ChartParser(nltk.CFG.fromstring(text))
+    try:
+        _store(parser, path, cache_dir)
+    except OSError as e:
+        logger.warning("Could not store compiled grammar in %s: %s", cache_dir, e)
+
+    return parser
+
+
+def _store(parser, path, cache_dir):
+    """
+    Write a parser to the cache. It is written to a temporary file that is
+    then renamed, so workers starting at the same time never read half a file
+
+    Arguments:
+        parser (ChartParser): The parser
+        path (string): Path of the file to write
+        cache_dir (string): Directory of the cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(parser, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".pickle")]
+    if len(files) > GRAMMAR_CACHE_FILES:
+        files.sort(key=os.path.getmtime)
+        for old in files[:len(files) - GRAMMAR_CACHE_FILES]:
+            try:
+                os.unlink(old)
+            except OSError:
+                pass
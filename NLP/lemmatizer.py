@@ -1,8 +1,123 @@
-from fuzzywuzzy import fuzz
-from nltk.stem import WordNetLemmatizer
+import math
+import threading
+from functools import lru_cache
+from data.metrics import REGISTRY
 
 SIMILARITY_THRESHOLD = 80
 
+# Maximum number of words remembered by lemmatize_word
+LEMMA_CACHE_SIZE = 4096
+
+# Shared lemmatizer, created on first use. WordNet is loaded lazily by nltk
+# in a way that isn't thread-safe, so the first load happens under a lock
+_lemmatizer = None
+_lemmatizer_lock = threading.Lock()
+
+# fuzzywuzzy's fuzz module, imported on first use
+_fuzz = None
+
+# Precomputed lemmas for the grammar vocabulary and schema names, the least
+# recently preloaded words are dropped once it holds LEMMA_TABLE_SIZE words
+_lemma_table = {}
+_lemma_table_lock = threading.Lock()
+
+# Maximum number of words in the table of precomputed lemmas
+LEMMA_TABLE_SIZE = 65536
+
+# Maximum number of looked up words remembered by a FuzzyIndex
+FUZZY_CACHE_SIZE = 4096
+
+class FuzzyIndex:
+    """
+    Prebuilt index over a vocabulary for fuzzy matching.
+
+    fuzz.ratio can never be higher than 2 * min(len(a), len(b)) / (len(a) + len(b)),
+    so words are bucketed by length and whole buckets that can't beat the
+    threshold are skipped without being scored. The surviving candidates are
+    scored with fuzz.ratio exactly like find_best_match, and ties go to the
+    word that came first in the vocabulary, so the matches are the same as
+    scanning every word.
+    """
+    def __init__(self, valid_words, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._by_length = {}
+        self._cache = {}
+
+        seen = set()
+        for order, item in enumerate(valid_words):
+            if item in seen:
+                continue
+            seen.add(item)
+            lowered = item.lower()
+            self._by_length.setdefault(len(lowered), []).append((order, lowered, item))
+
+        self.words = frozenset(seen)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+    def best_match(self, word):
+        """
+        Find the best matching word in the index
+
+        Argument:
+            word (string): The word that we are looking the best matching word for
+
+        Returns:
+            string: The word that closely resembles the inputted word
+                    or None if nothing is above the threshold
+        """
+        if word in self._cache:
+            return self._cache[word]
+
+        ratio = get_fuzz().ratio
+        lowered = word.lower()
+        length = len(lowered)
+
+        best_match = None
+        best_score = self.threshold
+        best_order = None
+        for other_length, bucket in self._by_length.items():
+            # Upper bound of the ratio for any word of this length
+            bound = math.ceil(200 * min(length, other_length) / (length + other_length)) if length else 0
+            if bound <= best_score and not (bound == best_score and best_match is not None):
+                continue
+
+            for order, item_lower, item in bucket:
+                score = ratio(lowered, item_lower)
+                if score > best_score or (score == best_score and best_match is not None and order < best_order):
+                    best_score = score
+                    best_match = item
+                    best_order = order
+
+        if len(self._cache) >= FUZZY_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[word] = best_match
+
+        return best_match
+
+    def best_matches(self, words):
+        """
+        Find the best matching word for every word of a sentence in one call.
+        Repeated words are only scored once
+
+        Argument:
+            words (list): Words that we are looking the best matching words for
+
+        Returns:
+            list: Best match (or None) for each word, in the same order
+        """
+        matches = {}
+        for word in words:
+            if word not in matches:
+                matches[word] = self.best_match(word)
+
+        return [matches[word] for word in words]
+
+
 def find_best_match(word, valid_words):
     """
     Find the best matching word through lemmatization and fuzzywuzzy.
@@ -14,11 +129,16 @@ def find_best_match(word, valid_words):
 
     Arguments:
         word (string): The word that we are looking the best matching word for
-        valid_words (list): List of valid words
+        valid_words (list): List of valid words or a prebuilt FuzzyIndex
 
     Returns:
         string: The word that closely resembles the inputted word
     """
+    if isinstance(valid_words, FuzzyIndex):
+        return valid_words.best_match(word)
+
+    fuzz = get_fuzz()
+
     best_match = None
     best_score = SIMILARITY_THRESHOLD
     
@@ -42,8 +162,97 @@ def lemmatize_word(word):
     Returns:
         string: Word converted to singular form
     """
-    lemmatizer = WordNetLemmatizer()
-    return lemmatizer.lemmatize(word)
+    lemma = _lemma_table.get(word)
+    if lemma is None:
+        lemma = _cached_lemmatize(word)
+
+    return lemma
+
+def get_lemmatizer():
+    """
+    Get the lemmatizer shared by the whole process.
+    nltk is only imported, and WordNet loaded, the first time this is
+    called. Threads calling it meanwhile wait for the load to finish
+
+    Returns:
+        WordNetLemmatizer
+    """
+    global _lemmatizer
+    if _lemmatizer is None:
+        with _lemmatizer_lock:
+            if _lemmatizer is None:
+                from nltk.stem import WordNetLemmatizer
+                lemmatizer = WordNetLemmatizer()
+                # Load WordNet before any other thread can use the lemmatizer
+                lemmatizer.lemmatize("movies")
+                _lemmatizer = lemmatizer
+
+    return _lemmatizer
+
+def get_fuzz():
+    """
+    Get fuzzywuzzy's fuzz module, importing it the first time
+
+    Returns:
+        module: fuzzywuzzy.fuzz
+    """
+    global _fuzz
+    if _fuzz is None:
+        from fuzzywuzzy import fuzz
+        _fuzz = fuzz
+
+    return _fuzz
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def _cached_lemmatize(word):
+    return get_lemmatizer().lemmatize(word)
+
+
+def _lemma_cache_metrics():
+    info = _cached_lemmatize.cache_info()
+    return [("naturalsql_lemma_cache_hits_total", "Lemmas answered from the WordNet lemma cache", "counter",
+             [({}, info.hits)]),
+            ("naturalsql_lemma_cache_misses_total", "Lemmas looked up in WordNet", "counter",
+             [({}, info.misses)])]
+
+
+REGISTRY.add_collector(_lemma_cache_metrics)
+
+def preload_lemmas(words, lemmas=None):
+    """
+    Precompute the lemmas of known words, like the grammar vocabulary
+    and the table and column names, so that lemmatizing them never
+    has to go to WordNet. Words that drop out of the bounded table
+    are looked up through the lemma cache again
+
+    Arguments:
+        words (iterable): Words to precompute
+        lemmas (dict): Optional already known word -> lemma mapping,
+                       used instead of WordNet for the words it contains
+    """
+    for word in words:
+        lemma = _lemma_table.get(word)
+        if lemma is None:
+            lemma = lemmas[word] if lemmas is not None and word in lemmas else _cached_lemmatize(word)
+
+        with _lemma_table_lock:
+            # Re-inserted so the words of vocabularies still in use are dropped last
+            _lemma_table.pop(word, None)
+            _lemma_table[word] = lemma
+            while len(_lemma_table) > LEMMA_TABLE_SIZE:
+                del _lemma_table[next(iter(_lemma_table))]
+
+
+def forget_lemmas(words):
+    """
+    Remove precomputed lemmas
+
+    Argument:
+        words (iterable): Words to remove
+    """
+    with _lemma_table_lock:
+        for word in words:
+            _lemma_table.pop(word, None)
 
 def resolve_tokens(tokens, valid_vocabulary):
     """
@@ -51,14 +260,16 @@ def resolve_tokens(tokens, valid_vocabulary):
 
     Args:
         tokens (list): A list of words from the user.
-        valid_vocabulary (dict): A dictionary categorizing known words.
+        valid_vocabulary (dict): A dictionary categorizing known words,
+                                 or a compiled Vocabulary.
     
     Returns:
         list: A new list of tokens where words have been corrected.
     """
-    resolved_tokens = []
+    if not isinstance(valid_vocabulary, dict):
+        return _resolve_with_index(tokens, valid_vocabulary.grammar_index)
 
-    # Convert valid vocabulary dictionary to single set for use in find_best_match function
+    # Convert valid vocabulary dictionary to single set for use in the fuzzy index
     known_grammar_words = set(
         valid_vocabulary.get('V', []) + 
         valid_vocabulary.get('Det', []) + 
@@ -72,12 +283,31 @@ def resolve_tokens(tokens, valid_vocabulary):
         valid_vocabulary.get('ValPlaceholder', [])
     )
 
+    return _resolve_with_index(tokens, FuzzyIndex(known_grammar_words))
+
+def _resolve_with_index(tokens, index):
+    """
+    Resolve tokens against a prebuilt fuzzy index
+
+    Arguments:
+        tokens (list): A list of words from the user.
+        index (FuzzyIndex): Index of the known grammar words.
+
+    Returns:
+        list: A new list of tokens where words have been corrected.
+    """
+    resolved_tokens = []
+
+    # Score every unknown token of the sentence in one batched call
+    unknown_tokens = [token for token in tokens if token not in index]
+    best_matches = dict(zip(unknown_tokens, index.best_matches(unknown_tokens)))
+
     for token in tokens:
-        if token in known_grammar_words:
+        if token in index:
             resolved_tokens.append(token)
 
         else:
-            best_match = find_best_match(token, known_grammar_words)
+            best_match = best_matches[token]
             if best_match:
                 resolved_tokens.append(best_match)
             else:
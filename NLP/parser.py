@@ -1,29 +1,423 @@
-import nltk
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from NLP.lemmatizer import *
 from NLP.grammar import *
+from NLP.grammar_cache import GRAMMAR_CACHE_DIR, load_parser
 from NLP.sql_translator import *
+from NLP.template_cache import fill_params, fill_template, num_slots, value_slots
+from NLP.vocabulary import get_vocabulary
+from data.metrics import CACHE_HITS, CACHE_MISSES, PARSE_FAILURES, record, stage
+from data.schema_catalog import SCHEMA_CATALOG
 
-def init_parser():
+# Maximum number of parsers kept by a ParserRegistry
+PARSER_CACHE_SIZE = 8
+
+# Most chart edges and seconds spent parsing one sentence before giving up on it
+PARSE_EDGE_LIMIT = 100000
+PARSE_TIME_LIMIT = 2.0
+
+# Parsers of the parts of a sentence, see segment_parser
+_segment_parsers = weakref.WeakKeyDictionary()
+_segment_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+def init_parser(db_path=DB_PATH, table="", cache_dir=GRAMMAR_CACHE_DIR):
     """
     Initiates the parser so that it can handle our current static grammar
     along with dynamic table and column names
 
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+        cache_dir (string): Directory compiled parsers are cached in, or None
+
     Returns:
         parser
     """
-    column_names, table_names = get_column_and_tablenames()
+    vocab = get_vocabulary(db_path, table)
 
-    col_rules = "Col -> " + " | ".join(f'"{col}"' for col in column_names) + "\n"
-    table_rules = "Table -> " + " | ".join(f'"{table}"' for table in table_names) + ' | "table" | "data"\n'
+    col_rules = ""
+    if vocab["Col"]:
+        col_rules = "Col -> " + " | ".join(f'"{col}"' for col in vocab["Col"]) + "\n"
+    table_rules = "Table -> " + " | ".join(f'"{table}"' for table in vocab["Table"]) + "\n"
 
     true_terminals = TERMINALS + "\n" + col_rules + "\n" + table_rules
 
-    grammar = nltk.CFG.fromstring(NONTERMINALS + true_terminals)
-    parser = nltk.ChartParser(grammar)
+    return load_parser(NONTERMINALS + true_terminals, cache_dir)
+
+class ParserRegistry:
+    """
+    Lazily builds and caches one parser per (database, selected table) schema.
+    The least recently used parsers are dropped once more than `max_size`
+    are held, so pointing the server at many databases doesn't keep every
+    grammar in memory
+    """
+    def __init__(self, max_size=PARSER_CACHE_SIZE):
+        self.max_size = max_size
+        self._parsers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, db_path=DB_PATH, table=""):
+        """
+        Get the parser for a database and table, building it if needed
+
+        Arguments:
+            db_path (string): Path to the database file
+            table (string): Name of the selected table, or "" for the whole database
+
+        Returns:
+            parser
+        """
+        entry = SCHEMA_CATALOG.get(db_path)
+        if table not in entry.tables:
+            table = ""
+        key = (os.path.abspath(db_path), table, entry.fingerprint)
+
+        with self._lock:
+            parser = self._parsers.get(key)
+            if parser is not None:
+                self._parsers.move_to_end(key)
+                CACHE_HITS.inc("parser")
+                return parser
+
+            CACHE_MISSES.inc("parser")
+            parser = init_parser(db_path, table)
+            self._parsers[key] = parser
+            while len(self._parsers) > self.max_size:
+                self._parsers.popitem(last=False)
+
+        return parser
+
+    def __len__(self):
+        return len(self._parsers)
+
+class ParseStats:
+    """
+    Counts how much work was done to parse a sentence
+
+    Attributes:
+        edges (int): Number of edges added to the parse charts
+        trees (int): Number of parse trees that were handed out
+        stopped_early (bool): True if parsing stopped at the first complete parse
+        budget_exceeded (bool): True if parsing was given up because it ran out of budget
+    """
+    __slots__ = ("edges", "trees", "stopped_early", "budget_exceeded")
+
+    def __init__(self):
+        self.edges = 0
+        self.trees = 0
+        self.stopped_early = False
+        self.budget_exceeded = False
+
+    def __repr__(self):
+        return (f"ParseStats(edges={self.edges}, trees={self.trees}, stopped_early={self.stopped_early}, "
+                f"budget_exceeded={self.budget_exceeded})")
+
+class ParseBudget:
+    """
+    Limits how much work may go into parsing one sentence. The clock
+    starts when the budget is made, and the edges of every chart built
+    for the sentence count towards the same limit
+
+    Attributes:
+        max_edges (int): Number of chart edges parsing may add, or None
+        deadline (float): perf_counter value parsing must end by, or None
+        edges (int): Number of edges added so far
+    """
+    __slots__ = ("max_edges", "deadline", "edges")
+
+    def __init__(self, max_edges=PARSE_EDGE_LIMIT, time_limit=PARSE_TIME_LIMIT):
+        self.max_edges = max_edges
+        self.deadline = time.perf_counter() + time_limit if time_limit is not None else None
+        self.edges = 0
+
+    def exceeded(self, chart_edges=0):
+        """
+        Tell whether parsing has to stop
+
+        Argument:
+            chart_edges (int): Edges in the chart being built, on top of the ones already counted
+
+        Returns:
+            bool: True once either limit is reached
+        """
+        if self.max_edges is not None and self.edges + chart_edges > self.max_edges:
+            return True
+        return self.deadline is not None and time.perf_counter() > self.deadline
+
+def iter_parses(parser, tokens, mode="all", stats=None, budget=None):
+    """
+    Parse a list of tokens and yield the parse trees one at a time
+
+    In "all" mode the whole chart is built like `parser.parse` does.
+    In "first" mode the chart stops growing as soon as an edge spanning
+    the whole sentence with the start symbol is found, so an ambiguous
+    sentence doesn't pay for the parses that would be thrown away.
+    In "segments" mode the sentence is split at its clause keywords and
+    each part is parsed on its own, see parse_segments. Sentences that
+    can't be split that way are parsed as in "first" mode
+
+    Arguments:
+        parser (ChartParser): Parser that will be parsing the tokens
+        tokens (list): Preprocessed words of the sentence
+        mode (string): "all", "first" or "segments"
+        stats (ParseStats): Optional counters that get filled in while parsing
+        budget (ParseBudget): Optional limit on the work; nothing is yielded
+                              if parsing runs out of it
+
+    Yields:
+        Tree: Parse trees of the sentence
+    """
+    if stats is None:
+        stats = ParseStats()
+
+    if mode == "segments":
+        tree = parse_segments(parser, tokens, stats, budget)
+        if tree is not None:
+            stats.trees += 1
+            yield tree
+            return
+        if stats.budget_exceeded:
+            return
+        mode = "first"
+
+    if parser._use_agenda:
+        chart = _chart_parse_bounded(parser, tokens, stats, mode != "all", budget)
+        if stats.budget_exceeded:
+            return
+    else:
+        chart = parser.chart_parse(tokens)
+        stats.edges += chart.num_edges()
+
+    for tree in chart.parses(parser.grammar().start()):
+        stats.trees += 1
+        yield tree
+
+def _chart_parse_bounded(parser, tokens, stats, first=True, budget=None):
+    """
+    Same agenda loop as `ChartParser.chart_parse` but able to stop once
+    a complete parse of the sentence is in the chart, and once the budget
+    runs out
+
+    Arguments:
+        parser (ChartParser): Parser that will be parsing the tokens
+        tokens (list): Preprocessed words of the sentence
+        stats (ParseStats): Counters that get filled in while parsing
+        first (bool): Stop at the first complete parse
+        budget (ParseBudget): Optional limit on the work
+
+    Returns:
+        Chart: The (possibly partial) parse chart
+    """
+    grammar = parser.grammar()
+    tokens = list(tokens)
+    grammar.check_coverage(tokens)
+    chart = parser._chart_class(tokens)
+
+    start = grammar.start()
+    end = chart.num_leaves()
+    found = False
+
+    def is_parse(edge):
+        return edge.is_complete() and edge.lhs() == start and edge.start() == 0 and edge.end() == end
+
+    for axiom in parser._axioms:
+        for edge in axiom.apply(chart, grammar):
+            if first and is_parse(edge):
+                found = True
+
+    agenda = chart.edges()
+    agenda.reverse()
+    while agenda and not found:
+        if budget is not None and budget.exceeded(chart.num_edges()):
+            stats.budget_exceeded = True
+            break
+
+        edge = agenda.pop()
+        for rule in parser._inference_rules:
+            new_edges = list(rule.apply(chart, grammar, edge))
+            agenda += new_edges
+            if first and any(is_parse(new_edge) for new_edge in new_edges):
+                found = True
+                break
+
+    stats.stopped_early = stats.stopped_early or found
+    stats.edges += chart.num_edges()
+    if budget is not None:
+        budget.edges += chart.num_edges()
+    return chart
+
+def segment_tokens(tokens):
+    """
+    Split a preprocessed sentence into the words before its first clause
+    and its clauses. A clause starts at a word of a CLAUSE_KEYWORDS category
+    and runs until a word starting a different kind of clause
+
+    Argument:
+        tokens (list): Preprocessed words of the sentence
+
+    Returns:
+        list: (start symbol, words) of each part, in order
+    """
+    clause_of = {word: symbol for category, symbol in CLAUSE_KEYWORDS.items()
+                 for word in VALID_VOCABULARY[category]}
+
+    segments = [(SEGMENT_HEAD, [])]
+    for token in tokens:
+        symbol = clause_of.get(token)
+        if symbol is not None and symbol != segments[-1][0]:
+            segments.append((symbol, []))
+        segments[-1][1].append(token)
+
+    if not segments[0][1]:
+        segments.pop(0)
+
+    return segments
+
+def parse_segments(parser, tokens, stats=None, budget=None):
+    """
+    Parse a sentence part by part. Each part is parsed with a grammar whose
+    start symbol is the kind of the part, and a filter part is split again
+    at its conjunctions, so the cost grows with the length of the longest
+    part instead of the length of the sentence. The trees of the parts are
+    put together under the start symbol of the grammar, and that tree is
+    only returned if its shape is one the grammar allows
+
+    Arguments:
+        parser (ChartParser): Parser of the whole grammar
+        tokens (list): Preprocessed words of the sentence
+        stats (ParseStats): Optional counters that get filled in while parsing
+        budget (ParseBudget): Optional limit on the work
+
+    Returns:
+        Tree: Parse tree of the sentence, or None if a part couldn't be parsed
+    """
+    from nltk import Tree
+
+    if stats is None:
+        stats = ParseStats()
+
+    children = []
+    for symbol, words in segment_tokens(tokens):
+        if symbol == "FilterStatement":
+            tree = _parse_filter_segment(parser, words, stats, budget)
+        else:
+            tree = _parse_segment(parser, symbol, words, stats, budget)
+        if tree is None:
+            return None
+
+        # The head stands for the first few children of the sentence
+        children.extend(tree if symbol == SEGMENT_HEAD else [tree])
+
+    start = parser.grammar().start()
+    shapes = {tuple(str(symbol) for symbol in production.rhs())
+              for production in parser.grammar().productions(lhs=start)}
+    if tuple(child.label() for child in children) not in shapes:
+        return None
 
-    return parser
+    return Tree(start.symbol(), children)
 
-def process(sentence, parser, table=""):
+def _parse_filter_segment(parser, words, stats, budget):
+    """
+    Parse the filters of a sentence. Each filter between conjunctions is
+    parsed on its own, which also lets a sentence have more than the two
+    filters the grammar allows. If that fails the part is parsed whole
+
+    Arguments:
+        parser (ChartParser): Parser of the whole grammar
+        words (list): Words of the part
+        stats (ParseStats): Counters that get filled in while parsing
+        budget (ParseBudget): Optional limit on the work
+
+    Returns:
+        Tree: FilterStatement tree, or None
+    """
+    from nltk import Tree
+
+    clauses = [[]]
+    conjunctions = []
+    for word in words:
+        if word in VALID_VOCABULARY['Conj'] and clauses[-1]:
+            conjunctions.append(word)
+            clauses.append([])
+        else:
+            clauses[-1].append(word)
+
+    if len(clauses) > 1:
+        children = []
+        for idx, clause in enumerate(clauses):
+            tree = _parse_segment(parser, "FilterClause", clause, stats, budget) if clause else None
+            if tree is None:
+                break
+            if idx:
+                children.append(Tree("Conj", [conjunctions[idx - 1]]))
+            children.append(tree)
+        else:
+            return Tree("FilterStatement", children)
+
+        if stats.budget_exceeded:
+            return None
+
+    return _parse_segment(parser, "FilterStatement", words, stats, budget)
+
+def _parse_segment(parser, symbol, words, stats, budget):
+    """
+    Parse part of a sentence, stopping at its first parse
+
+    Arguments:
+        parser (ChartParser): Parser of the whole grammar
+        symbol (string): Start symbol of the part
+        words (list): Words of the part
+        stats (ParseStats): Counters that get filled in while parsing
+        budget (ParseBudget): Optional limit on the work
+
+    Returns:
+        Tree: Parse tree of the part, or None
+    """
+    sub_parser = segment_parser(parser, symbol)
+    chart = _chart_parse_bounded(sub_parser, words, stats, True, budget)
+    if stats.budget_exceeded:
+        return None
+
+    return next(chart.parses(sub_parser.grammar().start()), None)
+
+def segment_parser(parser, symbol):
+    """
+    Get a parser with the same productions as `parser` but a different
+    start symbol. They are built once per parser and dropped with it
+
+    Arguments:
+        parser (ChartParser): Parser of the whole grammar
+        symbol (string): The start symbol
+
+    Returns:
+        ChartParser: The parser
+    """
+    with _segment_lock:
+        parsers = _segment_parsers.get(parser)
+        if parsers is None:
+            parsers = _segment_parsers[parser] = {}
+
+        sub_parser = parsers.get(symbol)
+        if sub_parser is None:
+            import nltk
+
+            productions = parser.grammar().productions()
+            if symbol == SEGMENT_HEAD:
+                productions = productions + nltk.CFG.fromstring(SEGMENT_HEAD_RULES).productions()
+            grammar = nltk.CFG(nltk.Nonterminal(symbol), productions)
+            sub_parser = parsers[symbol] = nltk.ChartParser(grammar)
+
+    return sub_parser
+
+def process(sentence, parser, table="", db_path=DB_PATH, parse_mode="all", stats=None, templates=None,
+            parameterize=False, recognizer=None, parse_budget=None):
     """
     Take a sentence and processes it to be able to be
     translated into an SQL query
@@ -31,40 +425,133 @@ def process(sentence, parser, table=""):
     Arguments:
         sentence (string): Natural language sentence from user
         parser (ChartParser): Parser that will be parsing the sentence 
-        table (string): Name of the table being queried
+        table (string): Name of the table being queried. A table the database
+                        doesn't have is ignored, as if none was selected
+        db_path (string): Path to the database file
+        parse_mode (string): "all" to build the full parse chart, "first"
+                             to stop at the first complete parse or "segments"
+                             to parse the clauses of the sentence one by one
+        stats (ParseStats): Optional counters for the work done while parsing
+        templates (TemplateCache): Optional cache of SQL templates, letting
+                                   sentences of an already seen shape skip
+                                   parsing and translation
+        parameterize (bool): If True, return SQL with ? placeholders along
+                             with the parameters to bind to it
+        recognizer (ValueRecognizer): Optional recogniser of unquoted values
+        parse_budget (ParseBudget): Limit on the work spent parsing the sentence,
+                                    the default limits if None
 
     Returns:
         string: Either a valid SQL query
                 or an empty string if the sentence could not be 
                 parsed or translated properly
+        tuple: If parameterize is True, the SQL (or an empty string)
+               and a tuple of its parameters
     """
     # Convert input into list of words
-    s, unknown_words, true_vocab, numbers = preprocess(sentence)
+    s, unknown_words, true_vocab, numbers = preprocess(sentence, db_path, table, recognizer)
+    record(sentence=sentence, tokens=s)
+
+    # The table comes from the user, it is only used if the database has it
+    if table not in true_vocab.tables:
+        table = ""
+
+    if stats is None:
+        stats = ParseStats()
+    if parse_budget is None:
+        parse_budget = ParseBudget()
+
+    if templates is None:
+        result = translate_tokens(s, parser, unknown_words, true_vocab, numbers, table, parse_mode, stats,
+                                  parameterize, parse_budget)
+    else:
+        key = templates.make_key(s, table, true_vocab.fingerprint, parser, len(unknown_words), len(numbers),
+                                 parameterize, parse_mode)
+        template = templates.get(key)
+        if template is None:
+            template = translate_tokens(s, parser, value_slots(len(unknown_words)), true_vocab,
+                                        num_slots(len(numbers)), table, parse_mode, stats, parameterize,
+                                        parse_budget)
+            if parameterize:
+                template = json.dumps(template)
+            # Running out of time may not happen the next time, so that failure isn't kept
+            if not stats.budget_exceeded:
+                templates.put(key, template)
+        elif not (json.loads(template)[0] if parameterize else template):
+            PARSE_FAILURES.inc("cached")
+
+        if parameterize:
+            sql, params = json.loads(template)
+            result = sql, fill_params(params, unknown_words, numbers)
+        else:
+            result = fill_template(template, unknown_words, numbers)
+
+    sql, params = result if parameterize else (result, ())
+    record(sql=sql, params=list(params))
+    return result
+
+def translate_tokens(s, parser, unknown_words, true_vocab, numbers, table="", parse_mode="all", stats=None,
+                     parameterize=False, parse_budget=None):
+    """
+    Parse a preprocessed sentence and translate it into an SQL query
+
+    Arguments:
+        s (list): Preprocessed words of the sentence
+        parser (ChartParser): Parser that will be parsing the sentence
+        unknown_words (list): List of search values
+        true_vocab (Vocabulary): Vocabulary the sentence was preprocessed with
+        numbers (list): List of numbers that were extracted from the sentence
+        table (string): Name of the table being queried, ignored if it isn't one of the vocabulary
+        parse_mode (string): "all", "first" or "segments", see iter_parses
+        stats (ParseStats): Optional counters for the work done while parsing
+        parameterize (bool): If True, return the SQL with ? placeholders and its parameters
+        parse_budget (ParseBudget): Optional limit on the work spent parsing
+
+    Returns:
+        string: Either a valid SQL query or an empty string
+        tuple: If parameterize is True, the SQL and a tuple of its parameters
+    """
+    failed = ("", ()) if parameterize else ""
+    if stats is None:
+        stats = ParseStats()
+    if table not in true_vocab.tables:
+        table = ""
 
     # Attempt to parse sentence
     try:
-        trees = list(parser.parse(s))
+        with stage("parse"):
+            tree = next(iter_parses(parser, s, parse_mode, stats, parse_budget), None)
 
     except ValueError as e:
-        print(e)
-        return ""
-    if not trees:
-        print("Could not parse sentence.")
-        return ""
+        logger.info("Could not parse sentence: %s", e)
+        PARSE_FAILURES.inc("error")
+        return failed
+    if tree is None and stats.budget_exceeded:
+        logger.warning("Gave up parsing sentence after %d edges: %s", stats.edges, s)
+        PARSE_FAILURES.inc("budget")
+        return failed
+    if tree is None:
+        logger.info("Could not parse sentence: %s", s)
+        PARSE_FAILURES.inc("no_parse")
+        return failed
     
     if table == "":
-        table = extract_table_from_sentence(trees[0])
+        table = extract_table_from_sentence(tree)
 
     # TODO - Find way to use selected table if table couldn't be extracted from user input
     if not table:
-        print("Could not find table")
-        return ""
-
-    return translate_to_sql(trees, unknown_words, true_vocab, numbers, table)
+        logger.info("Could not find table: %s", s)
+        PARSE_FAILURES.inc("no_table")
+        return failed
 
+    with stage("translate"):
+        result = translate_to_sql([tree], unknown_words, true_vocab, numbers, table, parameterize)
+    if not (result[0] if parameterize else result):
+        PARSE_FAILURES.inc("no_sql")
 
+    return result
 
-def preprocess(sentence):
+def preprocess(sentence, db_path=DB_PATH, table="", recognizer=None):
     """
     Convert `sentence` to a list of its words.
     Pre-process sentence by converting all characters to lowercase
@@ -73,31 +560,35 @@ def preprocess(sentence):
     
     Arguments:
         sentence (string): A sentence written in natural language
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+        recognizer (ValueRecognizer): If given, values of the database written
+                                      without quotes are treated as if quoted
 
     Returns:
         processed_tokens (list): List of words in preprocessed sentence
         unknown_words (list): List of unknown words
-        true_vocab (dict): Dictionary containing the vocab from the grammar file
-                           that was then extended using the names of the table
-                           and columns
+        true_vocab (Vocabulary): Vocabulary from the grammar file that was then
+                                 extended using the names of the table and columns
         numbers (list): List of numbers that were extracted from the sentence
     """
-    sent_parsing, unknown_words = extract_search_value(sentence.lower())
-    tokens = nltk.word_tokenize(sent_parsing)
+    import nltk
 
-    column_names, table_names = get_column_and_tablenames()
-    true_vocab = VALID_VOCABULARY.copy()
-    true_vocab["Table"] = table_names
-    true_vocab["Col"] = column_names
-    true_vocab["Table"].extend(["table", "data"])
+    true_vocab = get_vocabulary(db_path, table)
+    known_words = true_vocab.known_words
 
-    # Converting unknown words
-    known_words = set()
-    for valid in true_vocab.values():
-        known_words.update(valid)
+    with stage("tokenize"):
+        if recognizer is not None:
+            sentence = recognizer.quote_values(sentence, known_words)
+
+        sent_parsing, unknown_words = extract_search_value(sentence.lower())
+        tokens = nltk.word_tokenize(sent_parsing)
 
-    lemmatized_tokens = [lemmatize_word(token) for token in tokens]
-    resolved_tokens = resolve_tokens(lemmatized_tokens, true_vocab)
+    # Converting unknown words
+    with stage("lemmatize"):
+        lemmatized_tokens = [lemmatize_word(token) for token in tokens]
+    with stage("resolve"):
+        resolved_tokens = resolve_tokens(lemmatized_tokens, true_vocab)
     
     processed_tokens = []
 
@@ -113,13 +604,3 @@ def preprocess(sentence):
             unknown_words.append(token)
 
     return processed_tokens, unknown_words, true_vocab, numbers
-
-
-
-
-
-
-
-
-
-
@@ -1,7 +1,7 @@
 from NLP.utils import *
 from data.db_utils import *
 
-def translate_to_sql(trees, unknown_words, true_vocab, numbers, table=""):
+def translate_to_sql(trees, unknown_words, true_vocab, numbers, table="", parameterize=False):
     """
     Translates a natural language sentence into an SQL query for a table
 
@@ -10,35 +10,66 @@ def translate_to_sql(trees, unknown_words, true_vocab, numbers, table=""):
                       tree of grammar nodes
         unknown_words (list): List of words that may be names of values for
                               WHERE clause
-        true_vocab (dict): Dictionary containing the vocab from the grammar file
-                           that was then extended using the names of the table
-                           and columns
+        true_vocab (Vocabulary): Vocabulary from the grammar file that was then
+                                 extended using the names of the table and columns
         numbers (list): List of numbers that were extracted from the sentence
         table (string): Name of the table
+        parameterize (bool): If True, values and numbers are left out of the
+                             SQL as ? placeholders and returned separately
 
     Return:
         string: The resulting SQL statement if able to translate the sentence
                 Else, a blank string
+        tuple: If parameterize is True, the SQL statement and a tuple of the
+               parameters to bind to it
     """
     first_tree = trees[0]
+    params = [] if parameterize else None
 
-    where_nums, lim_nums = split_numbers_by_context(first_tree, numbers)
+    # Every clause builder looks its nodes up in one index of the tree
+    index = TreeIndex(first_tree)
+    where_nums, lim_nums = split_numbers_by_context(first_tree, numbers, index)
 
     if table == "":
-        table = extract_table_from_sentence(first_tree)
+        table = extract_table_from_sentence(first_tree, index)
 
-    where = build_filter_clause(first_tree, unknown_words, where_nums, table)
-    order = build_order_by_clause(first_tree)
-    limit = build_limit_clause(first_tree, lim_nums)
+    nocase_columns = getattr(true_vocab, "nocase_columns", frozenset())
+    fts_columns = getattr(true_vocab, "fts_columns", {})
+    where = build_filter_clause(first_tree, unknown_words, where_nums, table, params, nocase_columns, fts_columns,
+                                index)
+    order = build_order_by_clause(first_tree, index)
+    limit = build_limit_clause(first_tree, lim_nums, params, index)
 
+    sql = _build_select(index, true_vocab, table, where, order, limit)
+    if parameterize:
+        return sql, (tuple(params) if sql else ())
+
+    return sql
+
+def _build_select(index, true_vocab, table, where, order, limit):
+    """
+    Puts the SELECT statement together from its clauses
+
+    Arguments:
+        index (TreeIndex): Index of the parse tree of the sentence
+        true_vocab (Vocabulary): Vocabulary of the sentence
+        table (string): Name of the table
+        where (string): WHERE clause
+        order (string): ORDER BY clause
+        limit (string): LIMIT clause
+
+    Returns:
+        string: The SQL statement, or a blank string
+    """
     # Starting with identifying SELECT *
-    if find_subtree(first_tree, "AllStatement"):
+    col_list = index.find("ColList")
+    if index.find("AllStatement"):
         return f"SELECT * FROM {table}{where}{order}{limit};"
     
-    elif find_subtree(first_tree, "ColList"):
+    elif col_list:
         cols = []
         existing = set()
-        for col in extract_cols_from_sentence(find_subtree(first_tree, "ColList"), true_vocab):
+        for col in extract_cols_from_sentence(col_list, true_vocab, index):
             if col not in existing:
                 existing.add(col)
                 cols.append(col)
@@ -48,12 +79,13 @@ def translate_to_sql(trees, unknown_words, true_vocab, numbers, table=""):
         
         cols_str = ", ".join(cols)
         return f"SELECT {cols_str} FROM {table}{where}{order}{limit};"
-    elif find_subtree(first_tree, "LimitClause"):
+    elif index.find("LimitClause"):
         return f"SELECT * FROM {table}{where}{order}{limit};"
     
     return ""
 
-def build_filter_clause(tree, unknown_words, where_nums, table):
+def build_filter_clause(tree, unknown_words, where_nums, table, params=None, nocase_columns=frozenset(),
+                        fts_columns=None, index=None):
     """
     Builds the WHERE and FOR clauses for the translated
     SQL query
@@ -63,59 +95,133 @@ def build_filter_clause(tree, unknown_words, where_nums, table):
         unknown_words (list): List of unknown words
         where_nums (list): List of numbers that were used in WHERE clauses
         table (string): Name of the table
+        params (list): If given, values are appended to it and the
+                       clause uses ? placeholders instead
+        nocase_columns (frozenset): (table, column) pairs with a COLLATE NOCASE
+                                    index. Text filters on them are written as
+                                    `col = value COLLATE NOCASE` so the index is
+                                    used, other text filters as `LOWER(col) = value`
+                                    which matches a LOWER(col) expression index
+        fts_columns (dict): (table, column) pairs -> FTS5 table indexing the column.
+                            "containing" filters on them are a MATCH lookup on the
+                            full-text index, other "containing" filters use LIKE
+        index (TreeIndex): Index of the tree, if already built
 
     Returns:
         where (string): WHERE clause for the SQL query
     """
-    filter_node = find_subtree(tree, "FilterStatement")
+    if index is None:
+        index = TreeIndex(tree)
+
+    filter_node = index.find("FilterStatement")
     where = ""
     if filter_node:
         where = " WHERE "
         word_idx = 0
         num_idx = 0
         for node in filter_node:
-            if find_subtree(node, "DetCol"):
-                det_col_tree = find_subtree(node, "DetCol")
-                col = find_subtree(det_col_tree, "Col")
+            det_col_tree = index.find("DetCol", node)
+            if det_col_tree:
+                col = index.find("Col", det_col_tree)
+
+                if index.find("ContainsVal", node):
+                    where += build_contains_filter(col.leaves()[0], unknown_words[word_idx], table,
+                                                   params, fts_columns or {})
+                    word_idx+=1
+
+                if index.find("IsVal", node):
+                    col_name = col.leaves()[0]
+                    if params is None:
+                        value = sql_string(unknown_words[word_idx])
+                    else:
+                        value = "?"
+                        params.append(unknown_words[word_idx])
 
-                if find_subtree(node, "IsVal"):
-                    where += "LOWER(" + col.leaves()[0] + ") = '" + (unknown_words[word_idx]) + "'"
+                    if (table, col_name) in nocase_columns:
+                        where += col_name + " = " + value + " COLLATE NOCASE"
+                    else:
+                        where += "LOWER(" + col_name + ") = " + value
                     word_idx+=1
                     
-                if find_subtree(node, "IsNum"):
-                     where += col.leaves()[0] + " = " + where_nums[num_idx]
+                if index.find("IsNum", node):
+                    if params is None:
+                        where += col.leaves()[0] + " = " + where_nums[num_idx]
+                    else:
+                        where += col.leaves()[0] + " = ?"
+                        params.append(to_sql_number(where_nums[num_idx]))
+                    num_idx+=1
 
-            elif find_subtree(node, "Conj"):
+            elif index.find("Conj", node):
                 where += " " + node[0].upper() + " "
         if where == " WHERE ":
             where = ""
 
     return where
 
-def build_order_by_clause(tree):
+def build_contains_filter(col_name, word, table, params=None, fts_columns=None):
+    """
+    Builds the condition of a "containing" filter. If the column has a
+    full-text index the matching rows are looked up in it, otherwise
+    the column is scanned with LIKE
+
+    Arguments:
+        col_name (string): Name of the column
+        word (string): Text the column should contain
+        table (string): Name of the table
+        params (list): If given, the search text is appended to it as is and
+                       the condition uses a ? placeholder instead
+        fts_columns (dict): (table, column) pairs -> FTS5 table indexing the column
+
+    Returns:
+        string: Condition for the WHERE clause
+    """
+    fts_table = (fts_columns or {}).get((table, col_name))
+    if params is None:
+        value = sql_string(word)
+    else:
+        # The raw text is bound on its own so a cached template can put
+        # another sentence's value in its place
+        value = "?"
+        params.append(word)
+
+    if fts_table:
+        # Column filter plus a quoted phrase, so the words are matched as written
+        phrase = "'" + col_name + " : \"' || replace(" + value + ", '\"', '\"\"') || '\"'"
+        return "rowid IN (SELECT rowid FROM " + fts_table + " WHERE " + fts_table + " MATCH " + phrase + ")"
+
+    if params is None:
+        return col_name + " LIKE " + sql_string("%" + word + "%")
+
+    return col_name + " LIKE '%' || " + value + " || '%'"
+
+def build_order_by_clause(tree, index=None):
     """
     Builds the ORDER BY clause for the translated
     SQL query
 
     Argument:
         tree: Parse tree that reporesents a sentence in a tree of grammar nodes
+        index (TreeIndex): Index of the tree, if already built
 
     Returns:
         order (string): ORDER BY clause for the SQL query
     """
-    filter_node = find_subtree(tree, "OrderClause")
+    if index is None:
+        index = TreeIndex(tree)
+
+    filter_node = index.find("OrderClause")
 
     order = ""
     if filter_node:
         order = " ORDER BY "
 
-        if find_subtree(filter_node, "DetCol"):
-            det_col_tree = find_subtree(filter_node, "DetCol")
-            col = find_subtree(det_col_tree, "Col")
+        det_col_tree = index.find("DetCol", filter_node)
+        if det_col_tree:
+            col = index.find("Col", det_col_tree)
 
             order += col.leaves()[0]
 
-            dir_node = find_subtree(filter_node, "OrderDir")
+            dir_node = index.find("OrderDir", filter_node)
             if dir_node:
                 dir = dir_node.leaves()[0]
                 if dir == "ascending" or dir == "asc":
@@ -128,7 +234,7 @@ def build_order_by_clause(tree):
 
     return order
 
-def build_limit_clause(tree, lim_nums):
+def build_limit_clause(tree, lim_nums, params=None, index=None):
     """
     Builds the LIMIT clause for the translated
     SQL query
@@ -136,16 +242,25 @@ def build_limit_clause(tree, lim_nums):
     Argument:
         tree: Parse tree that reporesents a sentence in a tree of grammar nodes
         lim_nums (list): List of numbers that were used in LIMIT clauses
+        params (list): If given, the limit is appended to it and the
+                       clause uses a ? placeholder instead
+        index (TreeIndex): Index of the tree, if already built
 
     Returns:
         limit (string): LIMIT clause for the SQL query
     """
-    filter_node = find_subtree(tree, "LimitClause")
+    if index is None:
+        index = TreeIndex(tree)
+
+    filter_node = index.find("LimitClause")
 
     limit = ""
     if filter_node:
-        num = find_subtree(tree, "NumPlaceholder")
-        if num:
+        num = index.find("NumPlaceholder")
+        if num and params is not None:
+            limit = " LIMIT ?"
+            params.append(to_sql_number(lim_nums[0]))
+        elif num:
             limit = " LIMIT " + (lim_nums[0])
         else:
             limit = " LIMIT 1"
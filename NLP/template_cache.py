@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from NLP.utils import to_sql_number
+from data.metrics import CACHE_HITS, CACHE_MISSES
+
+# Maximum number of templates kept in memory by a TemplateCache
+TEMPLATE_CACHE_SIZE = 1024
+
+# Markers standing in for the search values and numbers of a sentence
+VALUE_SLOT = "\x00v{}\x00"
+NUM_SLOT = "\x00n{}\x00"
+SLOT_PATTERN = re.compile("\x00([vn])(\\d+)\x00")
+
+_grammar_keys = weakref.WeakKeyDictionary()
+
+
+def grammar_key(parser):
+    """
+    Get a hash of the grammar a parser was built with, so that templates
+    made by different grammars never get mixed up
+
+    Argument:
+        parser (ChartParser): The parser
+
+    Returns:
+        string: Hash of the grammar's productions
+    """
+    key = _grammar_keys.get(parser)
+    if key is None:
+        grammar = parser.grammar()
+        text = str(grammar.start()) + "\n" + "\n".join(str(prod) for prod in grammar.productions())
+        key = hashlib.sha1(text.encode()).hexdigest()
+        _grammar_keys[parser] = key
+
+    return key
+
+
+def value_slots(count):
+    """
+    Get placeholders for the search values of a sentence
+
+    Argument:
+        count (int): Number of search values
+
+    Returns:
+        list: One slot marker per value
+    """
+    return [VALUE_SLOT.format(i) for i in range(count)]
+
+
+def num_slots(count):
+    """
+    Get placeholders for the numbers of a sentence
+
+    Argument:
+        count (int): Number of numbers
+
+    Returns:
+        list: One slot marker per number
+    """
+    return [NUM_SLOT.format(i) for i in range(count)]
+
+
+def fill_template(template, unknown_words, numbers):
+    """
+    Put the values and numbers of a sentence into a SQL template
+
+    Arguments:
+        template (string): SQL template with value and number slots
+        unknown_words (list): List of search values
+        numbers (list): List of numbers
+
+    Returns:
+        string: The SQL query
+    """
+    if "\x00" not in template:
+        return template
+
+    def fill(match):
+        slot = int(match.group(2))
+        # Value slots always sit inside an SQL string literal
+        return unknown_words[slot].replace("'", "''") if match.group(1) == "v" else numbers[slot]
+
+    return SLOT_PATTERN.sub(fill, template)
+
+
+def fill_params(params, unknown_words, numbers):
+    """
+    Put the values and numbers of a sentence into the parameters
+    of a parameterized SQL template
+
+    Arguments:
+        params (list): Parameters of the template, some of them slots
+        unknown_words (list): List of search values
+        numbers (list): List of numbers
+
+    Returns:
+        tuple: The parameters to bind
+    """
+    filled = []
+    for param in params:
+        match = SLOT_PATTERN.fullmatch(param) if isinstance(param, str) else None
+        if match is None:
+            filled.append(param)
+        elif match.group(1) == "v":
+            filled.append(unknown_words[int(match.group(2))])
+        else:
+            filled.append(to_sql_number(numbers[int(match.group(2))]))
+
+    return tuple(filled)
+
+
+class TemplateCache:
+    """
+    Cache from the shape of a preprocessed sentence to the SQL template it
+    translates to. Sentences that only differ in their quoted values and
+    numbers share a template, so they skip parsing and translation.
+
+    Templates are kept in an in-memory LRU and, when `path` is given, in a
+    SQLite file so that they survive restarts and can be shared by workers.
+    Each process opens its own connection to the file on first use, so a
+    cache made before the workers are forked can be used in all of them
+    """
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self._con = None
+        self._pid = None
+
+        # Connections inherited from the parent process, kept so they are never closed in a child
+        self._inherited = []
+
+    def make_key(self, tokens, table, fingerprint, parser, value_count, num_count, parameterize=False,
+                 parse_mode="all"):
+        """
+        Build the cache key of a preprocessed sentence
+
+        Arguments:
+            tokens (list): Preprocessed words of the sentence
+            table (string): Name of the table being queried
+            fingerprint (string): Fingerprint of the database schema
+            parser (ChartParser): Parser that parses the sentence
+            value_count (int): Number of search values in the sentence
+            num_count (int): Number of numbers in the sentence
+            parameterize (bool): True for templates with ? placeholders
+            parse_mode (string): How the sentence is parsed. Modes don't accept
+                                 the same sentences, so each has its own templates
+
+        Returns:
+            string: The key
+        """
+        text = json.dumps([tokens, table, fingerprint, grammar_key(parser), value_count, num_count, parameterize,
+                           parse_mode])
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a template
+
+        Argument:
+            key (string): Key made by make_key
+
+        Returns:
+            string: The template, or None if it isn't cached
+        """
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                CACHE_HITS.inc("template")
+                return template
+
+            if self.path:
+                row = self._connection().execute("SELECT template FROM templates WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    CACHE_HITS.inc("template")
+                    return row[0]
+
+            self.misses += 1
+            CACHE_MISSES.inc("template")
+            return None
+
+    def put(self, key, template):
+        """
+        Store a template
+
+        Arguments:
+            key (string): Key made by make_key
+            template (string): SQL template
+        """
+        with self._lock:
+            self._remember(key, template)
+
+            if self.path:
+                con = self._connection()
+                con.execute("INSERT OR REPLACE INTO templates(key, template) VALUES(?, ?)", (key, template))
+                con.commit()
+
+    def clear(self):
+        """
+        Drop every template, including the ones stored on disk
+        """
+        with self._lock:
+            self._templates.clear()
+            if self.path:
+                con = self._connection()
+                con.execute("DELETE FROM templates")
+                con.commit()
+
+    def close(self):
+        """
+        Close the on-disk store of this process
+        """
+        with self._lock:
+            if self._con is not None and self._pid == os.getpid():
+                self._con.close()
+            elif self._con is not None:
+                self._inherited.append(self._con)
+            self._con = None
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _connection(self):
+        # SQLite connections must not be used on both sides of a fork, so a
+        # process that didn't open the current one opens its own
+        if self._con is None or self._pid != os.getpid():
+            if self._con is not None:
+                self._inherited.append(self._con)
+            con = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS templates(key TEXT PRIMARY KEY, template TEXT NOT NULL)")
+            con.commit()
+            self._con = con
+            self._pid = os.getpid()
+
+        return self._con
+
+    def _remember(self, key, template):
+        self._templates[key] = template
+        self._templates.move_to_end(key)
+        while len(self._templates) > self.max_size:
+            self._templates.popitem(last=False)
@@ -1,5 +1,6 @@
 import re
-from NLP.lemmatizer import find_best_match
+from bisect import bisect_left
+from NLP.lemmatizer import FuzzyIndex
 
 def extract_search_value(sentence):
     """
@@ -20,6 +21,42 @@ def extract_search_value(sentence):
     return processed_sentence, unknown_words
 
 
+def to_sql_number(number):
+    """
+    Convert a number taken from a sentence to a value that can be
+    bound to an SQL parameter
+
+    Argument:
+        number (string): The number as it was written
+
+    Returns:
+        int, float or string: The number, or the original text
+                              if it isn't a plain number
+    """
+    try:
+        return int(number)
+    except ValueError:
+        pass
+
+    try:
+        return float(number)
+    except ValueError:
+        return number
+
+
+def sql_string(value):
+    """
+    Quote a value as an SQL string literal
+
+    Argument:
+        value (string): The value
+
+    Returns:
+        string: The literal, with its single quotes doubled
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+
 def find_subtree(tree, label):
     """
     Helper function for finding subtrees with given label
@@ -39,40 +76,138 @@ def find_subtree(tree, label):
         
     return None
 
-def extract_cols_from_sentence(tree, true_vocab):
+class TreeIndex:
+    """
+    Index of a parse tree from label to the subtrees with that label, built
+    in one traversal. Subtrees are numbered in preorder, so the subtrees of
+    a node are the positions from the node up to the end of its span, and
+    the first subtree with a label under a node is found with a binary
+    search instead of another walk over the tree
+
+    Attributes:
+        tree: The indexed parse tree
+        nodes (list): Subtrees in preorder
+        ends (list): For each subtree, the position just past its last descendant
+    """
+    __slots__ = ("tree", "nodes", "ends", "_positions", "_position_of")
+
+    def __init__(self, tree):
+        nodes = []
+        parents = []
+        positions = {}
+        stack = [(tree, -1)]
+        while stack:
+            node, parent = stack.pop()
+            positions.setdefault(node.label(), []).append(len(nodes))
+            parents.append(parent)
+            parent = len(nodes)
+            nodes.append(node)
+            stack.extend((child, parent) for child in reversed(node) if not isinstance(child, str))
+
+        # The span of a node ends where the span of its last descendant does
+        ends = list(range(1, len(nodes) + 1))
+        for idx in range(len(nodes) - 1, 0, -1):
+            parent = parents[idx]
+            if ends[idx] > ends[parent]:
+                ends[parent] = ends[idx]
+
+        self.tree = tree
+        self.nodes = nodes
+        self.ends = ends
+        self._positions = positions
+        self._position_of = {id(node): idx for idx, node in enumerate(nodes)}
+
+    def find(self, label, within=None):
+        """
+        Same as find_subtree: the first subtree with a label in preorder
+
+        Arguments:
+            label (string): The label we are looking for
+            within: Subtree of the indexed tree to look in, the whole tree if None
+
+        Returns:
+            subtree: The subtree with the label, or None
+        """
+        found = self._positions.get(label)
+        if not found:
+            return None
+
+        start, end = self._span(within)
+        idx = bisect_left(found, start)
+        if idx < len(found) and found[idx] < end:
+            return self.nodes[found[idx]]
+
+        return None
+
+    def find_all(self, label, within=None):
+        """
+        Get every subtree with a label, in preorder
+
+        Arguments:
+            label (string): The label we are looking for
+            within: Subtree of the indexed tree to look in, the whole tree if None
+
+        Returns:
+            list: The subtrees with the label
+        """
+        found = self._positions.get(label, ())
+        start, end = self._span(within)
+        return [self.nodes[idx] for idx in found[bisect_left(found, start):bisect_left(found, end)]]
+
+    def position(self, subtree):
+        """
+        Get the preorder position of a subtree of the indexed tree
+
+        Argument:
+            subtree: The subtree
+
+        Returns:
+            int: Its position
+        """
+        return self._position_of[id(subtree)]
+
+    def _span(self, within):
+        if within is None:
+            return 0, len(self.nodes)
+
+        idx = self._position_of[id(within)]
+        return idx, self.ends[idx]
+
+def extract_cols_from_sentence(tree, true_vocab, index=None):
     """"
     Helper function for finding columns from a sentence
 
     Argument:
         tree: Parse tree that reporesents a sentence in a tree of grammar nodes
-        true_vocab (dict): Dictionary containing the vocab from the grammar file
-                           that was then extended using the names of the table
-                           and columns
+        true_vocab (Vocabulary): Vocabulary from the grammar file that was then
+                                 extended using the names of the table and columns
+        index (TreeIndex): Index of a tree `tree` is part of, if already built
 
     Returns:
         cols (list): List of columns found
     """
-    cols = []
-    for subtree in tree.subtrees():
-        if subtree.label() == 'Col':
-            word = subtree.leaves()[0]
-            best_match = find_best_match(word, true_vocab["Col"])
-            if best_match:
-                cols.append(best_match)
+    if index is None:
+        index = TreeIndex(tree)
+    words = [subtree.leaves()[0] for subtree in index.find_all('Col', tree)]
+    if isinstance(true_vocab, dict):
+        index = FuzzyIndex(true_vocab["Col"])
+    else:
+        index = true_vocab.col_index
 
-    return cols
+    return [best_match for best_match in index.best_matches(words) if best_match]
 
-def extract_table_from_sentence(tree):
+def extract_table_from_sentence(tree, index=None):
     """
     Helper function for finding the table from a sentence
 
     Argument:
         tree: Parse tree that reporesents a sentence in a tree of grammar nodes
+        index (TreeIndex): Index of the tree, if already built
 
     Returns:
         table: Name of the table
     """
-    table_tree = find_subtree(tree, "Table")
+    table_tree = index.find("Table") if index is not None else find_subtree(tree, "Table")
     table = ""
     
     if table_tree:
@@ -81,7 +216,7 @@ def extract_table_from_sentence(tree):
     return table
 
 
-def split_numbers_by_context(tree, numbers):
+def split_numbers_by_context(tree, numbers, index=None):
     """
     Split numbers into WHERE clause numbers and LIMIT clause numbers
     based on their position in the parse tree
@@ -89,6 +224,7 @@ def split_numbers_by_context(tree, numbers):
     Arguments:
         tree: Parse tree that reporesents a sentence in a tree of grammar nodes
         numbers (list): All numbers extracted from query
+        index (TreeIndex): Index of the tree, if already built
     
     Returns:
         where_numbers (list): Numbers that were in WHERE clauses
@@ -100,15 +236,21 @@ def split_numbers_by_context(tree, numbers):
     if not numbers:
         return where_numbers, lim_numbers
 
+    if index is None:
+        index = TreeIndex(tree)
+
     idx = 0
 
-    for subtree in tree.subtrees():
-        if subtree.label() == 'FilterClause':
-            for sub in subtree.subtrees():
-                if sub.label() == 'IsNum':
-                    where_numbers.append(numbers[idx])
-                    idx += 1
-        if subtree.label() == 'LimitClause':
+    # Clauses in the order they appear in the sentence
+    clauses = [(node, False) for node in index.find_all('FilterClause')]
+    clauses += [(node, True) for node in index.find_all('LimitClause')]
+    clauses.sort(key=lambda clause: index.position(clause[0]))
+    for subtree, is_limit in clauses:
+        if not is_limit:
+            for sub in index.find_all('IsNum', subtree):
+                where_numbers.append(numbers[idx])
+                idx += 1
+        else:
             lim_numbers.append(numbers[idx])
             idx += 1
 
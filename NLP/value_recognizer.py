@@ -0,0 +1,535 @@
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from data.connection_pool import get_pool
+from data.database import DB_PATH
+from data.loader import quote_identifier
+from data.schema_catalog import SCHEMA_CATALOG
+
+# Columns with more distinct values than this are not recognised
+VALUE_MAX_DISTINCT = 500000
+
+# Columns whose values barely repeat (names, ids...) are not recognised
+VALUE_MAX_RATIO = 0.9
+
+# Values shorter than this are too likely to be ordinary words
+VALUE_MIN_LENGTH = 3
+
+# Maximum number of recognisers kept in memory
+RECOGNIZER_CACHE_SIZE = 8
+
+# Least number of seconds between two syncs of a recogniser with its database
+VALUE_REFRESH_INTERVAL = 60.0
+
+# Transitions are keyed by state << _CHAR_BITS | code point
+_CHAR_BITS = 21
+
+_recognizers = OrderedDict()
+_lock = threading.Lock()
+
+# A value found in a sentence. `columns` holds the (table, column) pairs it came from
+ValueSpan = namedtuple("ValueSpan", ["start", "end", "value", "columns"])
+
+
+class ValueAutomaton:
+    """
+    Aho-Corasick automaton over the distinct values of text columns,
+    finding every value in a sentence in one pass over its characters.
+
+    The whole trie is one dict of int -> int transitions plus a few
+    int arrays indexed by state, which keeps hundreds of thousands of
+    values cheap in memory. Values can be added and removed in place.
+    A removed value only has its entry cleared, and after new values the
+    failure links are recomputed once, lazily, on the next search.
+    Changing an automaton while it is being searched is not safe, make
+    the changes on a copy instead
+
+    Attributes:
+        values (list): Text of each value id, or None once removed
+        columns (list): Tuple of the (table, column) pairs of each value id
+    """
+
+    def __init__(self):
+        self._goto = {}
+        self._fail = array("i", [0])
+        self._depth = array("i", [0])
+        self._parent = array("i", [0])
+        self._char = array("i", [0])
+        self._value_of = array("i", [-1])
+        self._out_link = array("i", [-1])
+        self._stale = False
+        self._removed = 0
+        self._lock = threading.Lock()
+        self.values = []
+        self.columns = []
+
+    def __len__(self):
+        return len(self.values) - self._removed
+
+    def copy(self):
+        """
+        Copy the automaton, so that it can be changed while this one is searched
+
+        Returns:
+            ValueAutomaton: The copy
+        """
+        copy = ValueAutomaton()
+        copy._goto = dict(self._goto)
+        for name in ("_fail", "_depth", "_parent", "_char", "_value_of", "_out_link"):
+            setattr(copy, name, array("i", getattr(self, name)))
+        copy._stale = self._stale
+        copy._removed = self._removed
+        copy.values = list(self.values)
+        copy.columns = list(self.columns)
+        return copy
+
+    def link(self):
+        """
+        Compute the failure links now instead of on the next search
+        """
+        with self._lock:
+            if self._stale:
+                self._build_links()
+
+    def add(self, value, column):
+        """
+        Add a value of a column
+
+        Arguments:
+            value (string): The value
+            column (tuple): (table, column) pair the value came from
+
+        Returns:
+            bool: True if the automaton changed
+        """
+        return self._insert(value, column)[0]
+
+    def _insert(self, value, column):
+        goto = self._goto
+        depth = self._depth
+        state = 0
+        for ch in value.lower():
+            code = ord(ch)
+            key = state << _CHAR_BITS | code
+            nxt = goto.get(key)
+            if nxt is None:
+                # The arrays grow before the transition is published, so a
+                # concurrent search never reaches a state without its entries
+                nxt = len(depth)
+                self._fail.append(0)
+                self._parent.append(state)
+                self._char.append(code)
+                self._value_of.append(-1)
+                self._out_link.append(-1)
+                depth.append(depth[state] + 1)
+                goto[key] = nxt
+            state = nxt
+
+        value_id = self._value_of[state]
+        if value_id == -1:
+            value_id = len(self.values)
+            self._value_of[state] = value_id
+            self.values.append(value)
+            self.columns.append((column,))
+            self._stale = True
+        elif self.values[value_id] is None:
+            # The state of a removed value is still linked, reviving it is enough
+            self.values[value_id] = value
+            self.columns[value_id] = (column,)
+            self._removed -= 1
+        elif column not in self.columns[value_id]:
+            self.columns[value_id] += (column,)
+        else:
+            return False, value_id
+
+        return True, value_id
+
+    def remove(self, value, column):
+        """
+        Remove a value of a column. The value stays in the automaton
+        while other columns still have it
+
+        Arguments:
+            value (string): The value
+            column (tuple): (table, column) pair the value came from
+
+        Returns:
+            bool: True if the automaton changed
+        """
+        value_id = self.lookup(value)
+        if value_id == -1 or column not in self.columns[value_id]:
+            return False
+
+        self.columns[value_id] = tuple(col for col in self.columns[value_id] if col != column)
+        if not self.columns[value_id]:
+            self.values[value_id] = None
+            self._removed += 1
+
+        return True
+
+    def lookup(self, value):
+        """
+        Find the id of a value
+
+        Argument:
+            value (string): The value
+
+        Returns:
+            int: Id of the value, or -1 if it isn't in the automaton
+        """
+        state = 0
+        for ch in value.lower():
+            state = self._goto.get(state << _CHAR_BITS | ord(ch))
+            if state is None:
+                return -1
+
+        value_id = self._value_of[state]
+        if value_id == -1 or self.values[value_id] is None:
+            return -1
+        return value_id
+
+    def sync_column(self, column, values):
+        """
+        Bring the values of a column up to date, adding and removing
+        only what changed
+
+        Arguments:
+            column (tuple): (table, column) pair
+            values (iterable): Current distinct values of the column
+
+        Returns:
+            tuple: Number of values added and removed
+        """
+        added = 0
+        seen = set()
+        for value in values:
+            if not isinstance(value, str) or len(value.strip()) < VALUE_MIN_LENGTH:
+                continue
+            changed, value_id = self._insert(value, column)
+            if changed:
+                added += 1
+            seen.add(value_id)
+
+        removed = 0
+        for value_id, cols in enumerate(self.columns):
+            if column in cols and value_id not in seen and self.remove(self.values[value_id], column):
+                removed += 1
+
+        # Removed values leave dead states behind, rebuild once they pile up
+        if self._removed > len(self.values) // 2:
+            self._compact()
+
+        return added, removed
+
+    def find(self, text):
+        """
+        Find the values in a text. Only whole words are matched and, where
+        values overlap, the leftmost and then longest one wins
+
+        Argument:
+            text (string): The text to search
+
+        Returns:
+            list: ValueSpan of each value found, in order
+        """
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._build_links()
+
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            lowered = "".join(ch.lower()[:1] for ch in text)
+
+        goto = self._goto
+        fail = self._fail
+        value_of = self._value_of
+        out_link = self._out_link
+        depth = self._depth
+        values = self.values
+
+        candidates = []
+        state = 0
+        for idx, ch in enumerate(lowered):
+            code = ord(ch)
+            while state and (state << _CHAR_BITS | code) not in goto:
+                state = fail[state]
+            state = goto.get(state << _CHAR_BITS | code, 0)
+
+            match = state if value_of[state] != -1 else out_link[state]
+            while match != -1:
+                end = idx + 1
+                start = end - depth[match]
+                value_id = value_of[match]
+                if (values[value_id] is not None and _is_boundary(lowered, start - 1)
+                        and _is_boundary(lowered, end)):
+                    candidates.append((start, -end, value_id))
+                match = out_link[match]
+
+        spans = []
+        last_end = 0
+        for start, neg_end, value_id in sorted(candidates):
+            if start >= last_end:
+                spans.append(ValueSpan(start, -neg_end, values[value_id], self.columns[value_id]))
+                last_end = -neg_end
+
+        return spans
+
+    def _build_links(self):
+        goto = self._goto
+        fail = self._fail
+        depth = self._depth
+        parent = self._parent
+        char = self._char
+        value_of = self._value_of
+        out_link = self._out_link
+
+        # States ordered by depth, so every parent is linked before its children
+        counts = [0] * (max(depth) + 2)
+        for d in depth:
+            counts[d + 1] += 1
+        for d in range(1, len(counts)):
+            counts[d] += counts[d - 1]
+        order = array("i", bytes(4 * len(depth)))
+        for state, d in enumerate(depth):
+            order[counts[d]] = state
+            counts[d] += 1
+
+        for state in order:
+            if depth[state] <= 1:
+                fail[state] = 0
+                out_link[state] = -1
+                continue
+
+            code = char[state]
+            link = fail[parent[state]]
+            while link and (link << _CHAR_BITS | code) not in goto:
+                link = fail[link]
+            link = goto.get(link << _CHAR_BITS | code, 0)
+
+            fail[state] = link
+            out_link[state] = link if value_of[link] != -1 else out_link[link]
+
+        self._stale = False
+
+    def _compact(self):
+        live = [(value, cols) for value, cols in zip(self.values, self.columns) if value is not None]
+        self.__init__()
+        for value, cols in live:
+            for col in cols:
+                self.add(value, col)
+
+
+class ValueRecognizer:
+    """
+    Recognises unquoted values of the low and medium cardinality text
+    columns of a database or table. The automaton is built in a background
+    thread on first use, as reading the values of a large database takes
+    long, and no values are recognised until it is ready. Once the database
+    file changes it is synced with the data, at most every
+    VALUE_REFRESH_INTERVAL seconds. A sync works on a copy of the automaton
+    that replaces the one in use when it is done, so searches never see a
+    half updated automaton
+
+    Attributes:
+        db_path (string): Path to the database file
+        table (string): Name of the table, or "" for the whole database
+        automaton (ValueAutomaton): Automaton over the values
+    """
+
+    def __init__(self, db_path=DB_PATH, table="", columns=None, refresh_interval=VALUE_REFRESH_INTERVAL):
+        self.db_path = db_path
+        self.table = table
+        self.automaton = None
+        self.refresh_interval = refresh_interval
+        self._columns = columns
+        self._stamp = None
+        self._fingerprint = None
+        self._synced_at = 0.0
+        self._syncing = False
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def refresh(self, wait=False):
+        """
+        Sync the automaton with the database in a background thread if the
+        file changed since the last sync
+
+        Argument:
+            wait (bool): Sync in the calling thread instead, and return once it is done
+        """
+        entry = SCHEMA_CATALOG.get(self.db_path)
+        if entry.stamp == self._stamp and entry.fingerprint == self._fingerprint:
+            return
+
+        if wait:
+            self._sync()
+            return
+
+        with self._lock:
+            # The first sync starts right away, later ones at most every refresh_interval seconds
+            if self._syncing or (self.automaton is not None
+                                 and time.monotonic() - self._synced_at < self.refresh_interval):
+                return
+            self._syncing = True
+
+        threading.Thread(target=self._sync, name="value-recognizer-sync", daemon=True).start()
+
+    def _sync(self):
+        try:
+            with self._sync_lock:
+                entry = SCHEMA_CATALOG.get(self.db_path)
+                if entry.stamp == self._stamp and entry.fingerprint == self._fingerprint:
+                    return
+
+                automaton = self.automaton.copy() if self.automaton is not None else ValueAutomaton()
+                columns = self._columns
+                if columns is None:
+                    columns = select_value_columns(self.db_path, self.table)
+
+                # Reading every value may take long, so it doesn't hold a pooled connection
+                with get_pool(self.db_path).dedicated() as con:
+                    for table, col in columns:
+                        values = (row[0] for row in
+                                  con.execute(f"SELECT DISTINCT {quote_identifier(col)} FROM {quote_identifier(table)}"))
+                        automaton.sync_column((table, col), values)
+
+                # Columns that are no longer recognised lose their values
+                kept = set(columns)
+                for value_id, cols in enumerate(automaton.columns):
+                    for column in cols:
+                        if column not in kept:
+                            automaton.remove(automaton.values[value_id], column)
+                automaton.link()
+
+                with self._lock:
+                    self.automaton = automaton
+                    self._stamp = entry.stamp
+                    self._fingerprint = entry.fingerprint
+                    self._synced_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._syncing = False
+
+    def find(self, sentence):
+        """
+        Find the values in a sentence
+
+        Argument:
+            sentence (string): A sentence written in natural language
+
+        Returns:
+            list: ValueSpan of each value found, in order. Empty until the
+                  automaton was first built
+        """
+        self.refresh()
+        automaton = self.automaton
+        if automaton is None:
+            return []
+
+        return automaton.find(sentence)
+
+    def quote_values(self, sentence, known_words=frozenset()):
+        """
+        Put quotes around the unquoted values of a sentence, so that
+        extract_search_value picks each one up as a single value
+
+        Arguments:
+            sentence (string): A sentence written in natural language
+            known_words (frozenset): Words of the grammar, never taken as values
+
+        Returns:
+            string: The sentence with its values quoted
+        """
+        quoted = _quoted_ranges(sentence)
+        pieces = []
+        last = 0
+        for span in self.find(sentence):
+            text = sentence[span.start:span.end]
+            if text.lower() in known_words or "'" in text or '"' in text:
+                continue
+            if any(start <= span.start < end for start, end in quoted):
+                continue
+            pieces.append(sentence[last:span.start])
+            pieces.append('"' + text + '"')
+            last = span.end
+        pieces.append(sentence[last:])
+
+        return "".join(pieces)
+
+
+def select_value_columns(db_path=DB_PATH, table=""):
+    """
+    Pick the text columns whose values are worth recognising: those
+    with repeated values and not too many distinct ones
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the table, or "" for the whole database
+
+    Returns:
+        list: (table, column) pairs
+    """
+    entry = SCHEMA_CATALOG.get(db_path)
+    tables = [table] if table in entry.tables else list(entry.tables)
+
+    columns = []
+    with get_pool(db_path).dedicated() as con:
+        for name in tables:
+            text_cols = [col for col in entry.tables[name] if entry.types[name].get(col) == "TEXT"]
+            if not text_cols:
+                continue
+
+            counts = ", ".join(f"COUNT(DISTINCT {quote_identifier(col)})" for col in text_cols)
+            row = con.execute(f"SELECT COUNT(*), {counts} FROM {quote_identifier(name)}").fetchone()
+            row_count = row[0]
+            for col, distinct in zip(text_cols, row[1:]):
+                if 0 < distinct <= VALUE_MAX_DISTINCT and distinct <= row_count * VALUE_MAX_RATIO:
+                    columns.append((name, col))
+
+    return columns
+
+
+def get_value_recognizer(db_path=DB_PATH, table=""):
+    """
+    Get the value recogniser of a database and table, building it on first use
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+
+    Returns:
+        ValueRecognizer: The recogniser
+    """
+    key = (os.path.abspath(db_path), table)
+    with _lock:
+        recognizer = _recognizers.get(key)
+        if recognizer is None:
+            recognizer = ValueRecognizer(db_path, table)
+            _recognizers[key] = recognizer
+            while len(_recognizers) > RECOGNIZER_CACHE_SIZE:
+                _recognizers.popitem(last=False)
+        else:
+            _recognizers.move_to_end(key)
+
+    return recognizer
+
+
+def _is_boundary(text, idx):
+    return idx < 0 or idx >= len(text) or not text[idx].isalnum()
+
+
+def _quoted_ranges(sentence):
+    ranges = []
+    start = None
+    for idx, ch in enumerate(sentence):
+        if ch in "\"'":
+            if start is None:
+                start = idx
+            else:
+                ranges.append((start, idx + 1))
+                start = None
+
+    return ranges
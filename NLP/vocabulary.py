@@ -0,0 +1,150 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from NLP.grammar import VALID_VOCABULARY
+from NLP.lemmatizer import FuzzyIndex, preload_lemmas
+from data.database import DB_PATH
+from data.metrics import CACHE_HITS, CACHE_MISSES
+from data.schema_catalog import SCHEMA_CATALOG
+
+# Maximum number of compiled vocabularies kept in memory
+VOCABULARY_CACHE_SIZE = 8
+
+# Categories whose words misspelled tokens get corrected to
+GRAMMAR_CATEGORIES = ('V', 'Det', 'P', 'Conj', 'Punc', 'Col', 'Table', 'All', 'Filter', 'Contain',
+                      'ValPlaceholder')
+
+_vocabularies = OrderedDict()
+_lock = threading.Lock()
+
+
+class Vocabulary:
+    """
+    Immutable vocabulary of the grammar extended with the table and
+    column names of a schema. It is compiled once per schema and shared
+    by preprocess, resolve_tokens and extract_cols_from_sentence, so
+    nothing is rebuilt per sentence
+
+    Attributes:
+        categories (mapping): Maps each grammar category to a tuple of its words
+        categories_of (mapping): Maps each word to the tuple of categories it is in
+        known_words (frozenset): Every word of the vocabulary
+        grammar_index (FuzzyIndex): Index of the words misspellings get corrected to
+        col_index (FuzzyIndex): Index of the column names
+        tables (frozenset): Names of the tables of the schema, the only ones queries may select from
+        nocase_columns (frozenset): (table, column) pairs that have a COLLATE NOCASE index
+        fts_columns (mapping): Maps (table, column) pairs to the FTS5 table indexing the column
+        fingerprint (string): Fingerprint of the schema the vocabulary was built from
+    """
+    __slots__ = ("categories", "categories_of", "known_words", "grammar_index", "col_index", "tables",
+                 "nocase_columns", "fts_columns", "fingerprint")
+
+    def __init__(self, column_names, table_names, fingerprint="", valid_vocabulary=VALID_VOCABULARY,
+                 nocase_columns=frozenset(), fts_columns=None):
+        categories = {category: tuple(sys.intern(word) for word in words)
+                      for category, words in valid_vocabulary.items()}
+        categories["Table"] = tuple(sys.intern(table) for table in table_names) + ("table", "data")
+        categories["Col"] = tuple(sys.intern(col) for col in column_names)
+
+        categories_of = {}
+        for category, words in categories.items():
+            for word in words:
+                categories_of[word] = categories_of.get(word, ()) + (category,)
+
+        grammar_words = [word for category in GRAMMAR_CATEGORIES for word in categories.get(category, ())]
+
+        set_attr = object.__setattr__
+        set_attr(self, "categories", MappingProxyType(categories))
+        set_attr(self, "categories_of", MappingProxyType(categories_of))
+        set_attr(self, "known_words", frozenset(categories_of))
+        set_attr(self, "grammar_index", FuzzyIndex(grammar_words))
+        set_attr(self, "col_index", FuzzyIndex(categories["Col"]))
+        set_attr(self, "tables", frozenset(table_names))
+        set_attr(self, "nocase_columns", frozenset(nocase_columns))
+        set_attr(self, "fts_columns", MappingProxyType(dict(fts_columns or {})))
+        set_attr(self, "fingerprint", fingerprint)
+
+        preload_lemmas(self.known_words)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Vocabulary is immutable")
+
+    def __getitem__(self, category):
+        return self.categories[category]
+
+    def __contains__(self, word):
+        return word in self.known_words
+
+    def get(self, category, default=()):
+        return self.categories.get(category, default)
+
+    def keys(self):
+        return self.categories.keys()
+
+    def values(self):
+        return self.categories.values()
+
+    def items(self):
+        return self.categories.items()
+
+
+def get_grammar_names(db_path=DB_PATH, table=""):
+    """
+    Get the column and table names that the grammar should know about.
+    When a table is selected only its own columns are used, which keeps
+    the Col and Table terminal sets (and the parse chart) small
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+
+    Returns:
+        column_names (list): List of column names
+        table_names (list): List of table names
+    """
+    entry = SCHEMA_CATALOG.get(db_path)
+    if table and table in entry.tables:
+        return list(entry.tables[table]), [table]
+
+    return list(entry.columns), list(entry.tables)
+
+
+def get_vocabulary(db_path=DB_PATH, table=""):
+    """
+    Get the compiled vocabulary of a database and table, compiling it
+    only when the schema changed
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the selected table, or "" for the whole database
+
+    Returns:
+        Vocabulary: The compiled vocabulary
+    """
+    entry = SCHEMA_CATALOG.get(db_path)
+    if table not in entry.tables:
+        table = ""
+    key = (os.path.abspath(db_path), table, entry.fingerprint)
+
+    with _lock:
+        vocab = _vocabularies.get(key)
+        if vocab is not None:
+            _vocabularies.move_to_end(key)
+            CACHE_HITS.inc("vocabulary")
+            return vocab
+
+        CACHE_MISSES.inc("vocabulary")
+
+        column_names, table_names = get_grammar_names(db_path, table)
+        nocase_columns = [(name, col) for name in table_names for col in entry.nocase.get(name, ())]
+        fts_columns = {(name, col): entry.fts[name][0]
+                       for name in table_names if name in entry.fts for col in entry.fts[name][1]}
+        vocab = Vocabulary(column_names, table_names, entry.fingerprint, nocase_columns=nocase_columns,
+                           fts_columns=fts_columns)
+        _vocabularies[key] = vocab
+        while len(_vocabularies) > VOCABULARY_CACHE_SIZE:
+            _vocabularies.popitem(last=False)
+
+    return vocab
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from NLP.lemmatizer import get_lemmatizer
+from NLP.value_recognizer import get_value_recognizer
+from NLP.vocabulary import get_vocabulary
+from data.database import DB_PATH
+from data.schema_catalog import SCHEMA_CATALOG
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Records how long each phase of the startup took
+    """
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the startup
+
+        Argument:
+            name (string): Name of the phase
+        """
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = time.perf_counter() - began
+
+    def record(self, name, seconds):
+        """
+        Record a phase that was timed elsewhere
+
+        Arguments:
+            name (string): Name of the phase
+            seconds (float): How long the phase took
+        """
+        with self._lock:
+            self.phases[name] = seconds
+
+    def report(self):
+        """
+        Build the startup-timing report
+
+        Returns:
+            string: One line per phase plus the time since the start
+        """
+        with self._lock:
+            lines = [f"{name:<12} {seconds * 1000:9.1f} ms" for name, seconds in self.phases.items()]
+        lines.append(f"{'total':<12} {(time.perf_counter() - self.start) * 1000:9.1f} ms")
+
+        return "\n".join(["Startup timing", "--------------"] + lines)
+
+
+def warm_up(db_path=DB_PATH, table="", parsers=None, timer=None):
+    """
+    Load everything the first request would otherwise have to wait for:
+    the tokenizer, WordNet, the schema, the vocabulary, the value
+    recogniser and the parser
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the table to build the parser for, or "" for the whole database
+        parsers (ParserRegistry): Registry to build the parser in
+        timer (StartupTimer): Timer that records each phase
+    """
+    if timer is None:
+        timer = StartupTimer()
+
+    with timer.phase("tokenizer"):
+        import nltk
+        nltk.word_tokenize("show me the movies")
+
+    with timer.phase("wordnet"):
+        get_lemmatizer().lemmatize("movies")
+
+    with timer.phase("schema"):
+        SCHEMA_CATALOG.get(db_path)
+
+    with timer.phase("vocabulary"):
+        get_vocabulary(db_path, table)
+
+    with timer.phase("values"):
+        get_value_recognizer(db_path, table).refresh(wait=True)
+
+    if parsers is not None:
+        with timer.phase("parser"):
+            parsers.get(db_path, table)
+
+
+def start_warm_up(db_path=DB_PATH, table="", parsers=None, timer=None, report=True):
+    """
+    Run warm_up in a background thread so it overlaps with starting the server
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the table to build the parser for
+        parsers (ParserRegistry): Registry to build the parser in
+        timer (StartupTimer): Timer that records each phase
+        report (bool): Log the startup-timing report when done
+
+    Returns:
+        Thread: The warm-up thread
+    """
+    if timer is None:
+        timer = StartupTimer()
+
+    def run():
+        try:
+            warm_up(db_path, table, parsers, timer)
+        except Exception:
+            logger.exception("Warm-up failed")
+        if report:
+            logger.info("%s", timer.report())
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
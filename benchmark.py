@@ -0,0 +1,371 @@
+"""
+Benchmarks every stage of turning a sentence into query results:
+tokenize, lemmatize, resolve_tokens, chart parse, translate_to_sql
+and execute_query. Runs over the sentences of tests.py and over
+generated sentences against synthetic databases, and prints the
+results as JSON so that runs on different commits can be compared.
+
+    python benchmark.py
+    python benchmark.py --columns 10 100 1000 --rows 1000 100000 10000000 --output bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from NLP.lemmatizer import lemmatize_word, resolve_tokens
+from NLP.parser import init_parser, iter_parses
+from NLP.sql_translator import translate_to_sql
+from NLP.utils import extract_search_value, extract_table_from_sentence
+from NLP.vocabulary import get_vocabulary
+from data.database import DB_PATH, execute_query
+from data.loader import quote_identifier
+
+STAGES = ("tokenize", "lemmatize", "resolve_tokens", "parse", "translate_to_sql", "execute_query")
+
+SYNTHETIC_TABLE = "records"
+
+# Distinct values of each text column of a synthetic table
+SYNTHETIC_TEXT_VALUES = 50
+
+
+def corpus_sentences():
+    """
+    Get the sentences of the test suite
+
+    Returns:
+        list: The sentences, without duplicates
+    """
+    import tests
+
+    sentences = list(tests.GOOD_SENTENCES) + list(tests.SELECT_ALL_SENTENCES)
+    for corpus in (tests.SELECT_FROM_COLUMNS_SENTENCES, tests.SIMILAR_SOUNDING_SENTENCES, tests.WHERE_SENTENCES,
+                   tests.ORDER_BY_SENTENCES, tests.LIMIT_SENTENCES):
+        sentences += list(corpus)
+
+    return list(dict.fromkeys(sentences))
+
+
+def build_synthetic_db(db_path, column_count, row_count):
+    """
+    Create a database with one wide table of generated rows.
+    Every third column is an INTEGER column, the rest are TEXT columns
+    with SYNTHETIC_TEXT_VALUES distinct values each
+
+    Arguments:
+        db_path (string): Path to the database file
+        column_count (int): Number of columns
+        row_count (int): Number of rows
+    """
+    columns = synthetic_columns(column_count)
+    definitions = ", ".join(f"{quote_identifier(col)} {col_type}" for col, col_type in columns)
+    values = ", ".join(f"(x * {idx + 7}) % 1000" if col_type == "INTEGER"
+                       else f"'v' || ((x + {idx}) % {SYNTHETIC_TEXT_VALUES})"
+                       for idx, (col, col_type) in enumerate(columns))
+
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute(f"CREATE TABLE {SYNTHETIC_TABLE} ({definitions})")
+        con.execute(f"WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < {row_count}) "
+                    f"INSERT INTO {SYNTHETIC_TABLE} SELECT {values} FROM n")
+    finally:
+        con.close()
+
+
+def synthetic_columns(column_count):
+    """
+    Names and types of the columns of a synthetic table
+
+    Argument:
+        column_count (int): Number of columns
+
+    Returns:
+        list: (name, type) pairs
+    """
+    return [(f"col{idx}", "INTEGER" if idx % 3 == 2 else "TEXT") for idx in range(column_count)]
+
+
+def generate_sentences(column_count, count, select_columns, seed=0):
+    """
+    Generate sentences against a synthetic table, from a plain column
+    list up to a long sentence with a filter, an order and a limit
+
+    Arguments:
+        column_count (int): Number of columns of the table
+        count (int): Number of sentences
+        select_columns (int): Number of columns asked for by the long sentences
+        seed (int): Seed of the random choices
+
+    Returns:
+        list: The sentences
+    """
+    rng = random.Random(seed)
+    columns = synthetic_columns(column_count)
+    text_cols = [col for col, col_type in columns if col_type == "TEXT"]
+    int_cols = [col for col, col_type in columns if col_type == "INTEGER"] or text_cols
+
+    def col_list(size):
+        cols = rng.sample([col for col, _ in columns], min(size, len(columns)))
+        return cols[0] if len(cols) == 1 else ", ".join(cols[:-1]) + " and " + cols[-1]
+
+    sentences = []
+    for idx in range(count):
+        shape = idx % 4
+        if shape == 0:
+            sentences.append(f"show me the {col_list(2)} of {SYNTHETIC_TABLE}")
+        elif shape == 1:
+            sentences.append(f"show me the {SYNTHETIC_TABLE} where {rng.choice(text_cols)} is "
+                             f"\"v{rng.randrange(SYNTHETIC_TEXT_VALUES)}\"")
+        elif shape == 2:
+            sentences.append(f"list the {col_list(3)} of {SYNTHETIC_TABLE} where {rng.choice(int_cols)} is "
+                             f"{rng.randrange(1000)} ordered by {rng.choice(int_cols)} descending")
+        else:
+            sentences.append(f"show me the {col_list(select_columns)} of {SYNTHETIC_TABLE} where "
+                             f"{rng.choice(text_cols)} is \"v{rng.randrange(SYNTHETIC_TEXT_VALUES)}\" and "
+                             f"{rng.choice(int_cols)} is {rng.randrange(1000)} ordered by "
+                             f"{rng.choice(int_cols)} ascending limit {rng.randrange(1, 100)}")
+
+    return sentences
+
+
+def run_stages(sentence, parser, db_path, table, parse_mode, execute, timings=None, memory=None):
+    """
+    Run a sentence through every stage of the pipeline, recording how long
+    each stage took or how much memory it allocated at its peak
+
+    Arguments:
+        sentence (string): A sentence written in natural language
+        parser (ChartParser): Parser of the database and table
+        db_path (string): Path to the database file
+        table (string): Name of the table, or "" to take it from the sentence
+        parse_mode (string): "all", "first" or "segments"
+        execute (bool): Run the translated query too
+        timings (dict): If given, stage -> list that the seconds of each stage are added to
+        memory (dict): If given, stage -> list that the peak bytes of each stage are added to
+
+    Returns:
+        bool: True if the sentence got translated
+    """
+    import nltk
+
+    state = {}
+
+    def stage(name, func):
+        if memory is not None:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        began = time.perf_counter()
+        result = func()
+        took = time.perf_counter() - began
+        if memory is not None:
+            memory[name].append(tracemalloc.get_traced_memory()[1] - before)
+        if timings is not None:
+            timings[name].append(took)
+        return result
+
+    vocab = get_vocabulary(db_path, table)
+
+    def tokenize():
+        sent_parsing, state["unknown_words"] = extract_search_value(sentence.lower())
+        return nltk.word_tokenize(sent_parsing)
+
+    tokens = stage("tokenize", tokenize)
+    lemmas = stage("lemmatize", lambda: [lemmatize_word(token) for token in tokens])
+    resolved = stage("resolve_tokens", lambda: resolve_tokens(lemmas, vocab))
+
+    words = []
+    numbers = []
+    unknown_words = state["unknown_words"]
+    for token in resolved:
+        if token in vocab.known_words:
+            words.append(token)
+        elif token.isnumeric():
+            numbers.append(token)
+            words.append("__num__")
+        else:
+            words.append("__value__")
+            unknown_words.append(token)
+
+    def parse():
+        try:
+            return next(iter_parses(parser, words, parse_mode), None)
+        except ValueError:
+            return None
+
+    tree = stage("parse", parse)
+    if tree is None:
+        return False
+
+    query_table = table or extract_table_from_sentence(tree)
+    query, params = stage("translate_to_sql", lambda: translate_to_sql([tree], unknown_words, vocab, numbers,
+                                                                       query_table, parameterize=True))
+    if not query:
+        return False
+
+    if execute:
+        try:
+            with redirect_stdout(io.StringIO()):
+                stage("execute_query", lambda: execute_query(query, db_path, params))
+        except sqlite3.Error:
+            return False
+
+    return True
+
+
+def summarize(samples, scale=1000.0):
+    """
+    Percentiles of a list of measurements
+
+    Arguments:
+        samples (list): The measurements
+        scale (float): Factor the measurements are multiplied by
+
+    Returns:
+        dict: Count, mean, p50, p90, p99 and max
+    """
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * scale
+
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered) * scale, "p50": percentile(50),
+            "p90": percentile(90), "p99": percentile(99), "max": ordered[-1] * scale}
+
+
+def benchmark(name, sentences, db_path, table, repeat=3, parse_mode="first", execute=True, measure_memory=True):
+    """
+    Benchmark every stage over a list of sentences
+
+    Arguments:
+        name (string): Name of the scenario
+        sentences (list): Sentences to run
+        db_path (string): Path to the database file
+        table (string): Name of the table, or "" to take it from the sentences
+        repeat (int): Number of timed runs over the sentences
+        parse_mode (string): "all", "first" or "segments"
+        execute (bool): Also run the translated queries
+        measure_memory (bool): Do an extra run under tracemalloc for the peak memory of each stage
+
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput in sentences per
+              second and peak memory in KiB, per stage and end to end
+    """
+    began = time.perf_counter()
+    parser = init_parser(db_path, table)
+    setup = time.perf_counter() - began
+
+    # One untimed run so imports and caches don't count against the first sentences
+    for sentence in sentences:
+        run_stages(sentence, parser, db_path, table, parse_mode, execute)
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    translated = 0
+    for _ in range(repeat):
+        for sentence in sentences:
+            began = time.perf_counter()
+            translated += run_stages(sentence, parser, db_path, table, parse_mode, execute, timings=timings)
+            totals.append(time.perf_counter() - began)
+
+    stages = {}
+    for stage in STAGES:
+        stats = summarize(timings[stage])
+        stats["throughput"] = len(timings[stage]) / sum(timings[stage]) if timings[stage] else 0.0
+        stages[stage] = stats
+
+    if measure_memory:
+        memory = {stage: [] for stage in STAGES}
+        tracemalloc.start()
+        try:
+            for sentence in sentences:
+                run_stages(sentence, parser, db_path, table, parse_mode, execute, memory=memory)
+        finally:
+            tracemalloc.stop()
+        for stage in STAGES:
+            stages[stage]["peak_kib"] = max(memory[stage], default=0) / 1024
+
+    end_to_end = summarize(totals)
+    end_to_end["throughput"] = len(totals) / sum(totals) if totals else 0.0
+
+    return {"name": name, "sentences": len(sentences), "repeat": repeat, "translated": translated / max(repeat, 1),
+            "parser_setup_ms": setup * 1000, "stages": stages, "end_to_end": end_to_end}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Benchmark each stage of the translation pipeline")
+    arg_parser.add_argument("--columns", type=int, nargs="*", default=[10],
+                            help="column counts of the synthetic tables, e.g. 10 100 1000")
+    arg_parser.add_argument("--rows", type=int, nargs="*", default=[1000],
+                            help="row counts of the synthetic tables, e.g. 1000 100000 10000000")
+    arg_parser.add_argument("--sentences", type=int, default=40, help="generated sentences per synthetic table")
+    arg_parser.add_argument("--select-columns", type=int, default=8,
+                            help="columns asked for by the long generated sentences")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="timed runs over each set of sentences")
+    arg_parser.add_argument("--parse-mode", choices=("first", "all", "segments"), default="first")
+    arg_parser.add_argument("--no-corpus", action="store_true", help="skip the sentences of the test suite")
+    arg_parser.add_argument("--no-execute", action="store_true", help="don't run the translated queries")
+    arg_parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    arg_parser.add_argument("--output", help="file to write the JSON results to, stdout by default")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    options = dict(repeat=args.repeat, parse_mode=args.parse_mode, execute=not args.no_execute,
+                   measure_memory=not args.no_memory)
+
+    scenarios = []
+    if not args.no_corpus:
+        scenarios.append(benchmark("corpus", corpus_sentences(), DB_PATH, "movies", **options))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for column_count in args.columns:
+            for row_count in args.rows:
+                db_path = os.path.join(tmp, f"synthetic_{column_count}_{row_count}.db")
+                began = time.perf_counter()
+                build_synthetic_db(db_path, column_count, row_count)
+                build_seconds = time.perf_counter() - began
+
+                sentences = generate_sentences(column_count, args.sentences, args.select_columns)
+                result = benchmark(f"synthetic_{column_count}x{row_count}", sentences, db_path,
+                                   SYNTHETIC_TABLE, **options)
+                result.update(columns=column_count, rows=row_count, build_seconds=build_seconds)
+                scenarios.append(result)
+
+    report = {
+        "meta": {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                 "python": platform.python_version(), "platform": platform.platform(), "args": vars(args),
+                 "units": {"latency": "ms", "throughput": "sentences/s", "peak": "KiB"}},
+        "scenarios": scenarios,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
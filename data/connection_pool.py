@@ -0,0 +1,207 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+# Maximum number of connections kept open per database
+POOL_SIZE = 4
+
+# Number of prepared statements each connection keeps around
+STATEMENT_CACHE_SIZE = 256
+
+# Pragmas run on every new connection
+SQLITE_PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+    "query_only": 1,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Pools inherited from the parent process, kept so their connections are never closed in a child
+_inherited = []
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only connections to one database file.
+
+    Connections are opened in read-only URI mode with the pragmas in
+    SQLITE_PRAGMAS and handed back to the pool after use, so their page
+    cache and prepared statements stay warm across requests
+
+    Attributes:
+        db_path (string): Path to the database file
+        size (int): Maximum number of connections
+        opened (int): Number of connections that were opened
+        reused (int): Number of times an already open connection was handed out
+    """
+    def __init__(self, db_path, size=POOL_SIZE, pragmas=None):
+        self.db_path = db_path
+        self.size = size
+        self.pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+        self.opened = 0
+        self.reused = 0
+
+        self._idle = []
+        self._in_use = 0
+        self._file_id = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool
+
+        Yields:
+            Connection: A read-only connection to the database
+        """
+        con, file_id = self._acquire()
+        try:
+            yield con
+        finally:
+            self._release(con, file_id)
+
+    @contextmanager
+    def dedicated(self):
+        """
+        Open a connection of its own, outside the pool, for a caller that
+        holds it for as long as a client takes to read, like a streamed
+        response. Pooled connections are never kept waiting on a slow client
+
+        Yields:
+            Connection: A read-only connection to the database, closed afterwards
+        """
+        con = self._connect()
+        try:
+            yield con
+        finally:
+            con.close()
+
+    def stats(self):
+        """
+        Get the usage counters of the pool
+
+        Returns:
+            dict: Opened, reused, idle and in use connection counts
+        """
+        with self._cond:
+            return {"opened": self.opened, "reused": self.reused,
+                    "idle": len(self._idle), "in_use": self._in_use}
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        with self._cond:
+            for con in self._idle:
+                con.close()
+            self._idle.clear()
+
+    def _acquire(self):
+        with self._cond:
+            self._check_file()
+            while not self._idle and self._in_use >= self.size:
+                self._cond.wait()
+
+            self._in_use += 1
+            file_id = self._file_id
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), file_id
+
+        try:
+            con = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self.opened += 1
+        return con, file_id
+
+    def _release(self, con, file_id):
+        if con.in_transaction:
+            con.rollback()
+
+        with self._cond:
+            self._in_use -= 1
+            if file_id == self._file_id:
+                self._idle.append(con)
+            else:
+                con.close()
+            self._cond.notify()
+
+    def _connect(self):
+        uri = "file:" + quote(os.path.abspath(self.db_path)) + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                              cached_statements=STATEMENT_CACHE_SIZE)
+        for name, value in self.pragmas.items():
+            con.execute(f"PRAGMA {name} = {value}")
+
+        return con
+
+    def _check_file(self):
+        # A replaced database file can't be seen through connections to the old one
+        try:
+            st = os.stat(self.db_path)
+            file_id = (st.st_dev, st.st_ino)
+        except OSError:
+            file_id = None
+
+        if file_id != self._file_id:
+            for con in self._idle:
+                con.close()
+            self._idle.clear()
+            self._file_id = file_id
+
+
+def get_pool(db_path, size=POOL_SIZE, pragmas=None):
+    """
+    Get the connection pool of a database, creating it on first use
+
+    Arguments:
+        db_path (string): Path to the database file
+        size (int): Maximum number of connections, used when the pool is created
+        pragmas (dict): Pragmas for new connections, used when the pool is created
+
+    Returns:
+        ConnectionPool: The pool of the database
+    """
+    key = os.path.abspath(db_path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(db_path, size, pragmas)
+                _pools[key] = pool
+
+    return pool
+
+
+def _reset_after_fork():
+    # Connections must not be used on both sides of a fork. The child drops
+    # the parent's pools without closing them and opens its own
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    _inherited.extend(_pools.values())
+    _pools.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def close_pools():
+    """
+    Close the idle connections of every pool
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -1,6 +1,10 @@
-import csv
-import sqlite3
-import pandas as pd
+import json
+import logging
+from itertools import islice
+from data.connection_pool import get_pool
+from data.metrics import QUERIES_INTERRUPTED, stage
+from data.query_budget import QueryBudget, QueryTooExpensive
+from data.query_result import QueryResult, html_table_end, html_table_rows, html_table_start
 
 # TODO - remove db_name, make it more dynamic
 DB_DIR = "data"
@@ -9,48 +13,26 @@ DB_PATH = DB_DIR + "/" + DB_NAME
 
 INPUT = "data/input/movies.csv"
 
+# Rows fetched from SQLite at a time when streaming results
+STREAM_BATCH_SIZE = 500
+
+# Most rows a streamed result will contain
+STREAM_MAX_ROWS = 10000
+
+logger = logging.getLogger(__name__)
+
 def set_up_table():
     """
     Create a table and populate it with data
     """
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-
-    table_name = "movies"
-    sql = f"DROP TABLE IF EXISTS {table_name}"
-
-    # Execute the SQL query
-    cur.execute(sql)
-
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS movies(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    year INTEGER,
-                    genre TEXT,
-                    director TEXT,
-                    rating FLOAT,
-                    runtime FLOAT
-                )
-                """)
-
-    contents = csv.reader(open(INPUT))
-    
-    cur.executemany("INSERT INTO movies (name, year, genre, director, rating, runtime) VALUES(?, ?, ?, ?, ?, ?)", contents)
-
-    select_all = "SELECT * FROM movies"
-    rows = cur.execute(select_all).fetchall()
-
-    # Output to the console screen
-    for r in rows:
-        print(r)
+    from data.loader import load_csv
 
-    con.commit()
-    con.close()
-    print("Database", DB_NAME, " has been created and populated")
+    load_csv(INPUT, "movies", DB_PATH, column_types={"rating": "FLOAT", "runtime": "FLOAT"}, id_column="id",
+             not_null=["name"])
+    logger.info("Database %s has been created and populated", DB_NAME)
 
 
-def execute_query(query, db_path=DB_PATH):
+def execute_query(query, db_path=DB_PATH, params=(), budget=None):
     """
     Connects to database and executes the query generated from
     translating the user's sentence. Displays the results of the
@@ -59,19 +41,188 @@ def execute_query(query, db_path=DB_PATH):
     Argument:
         query (string): The generated query
         db_path (string): Path to the database file
+        params (tuple): Parameters bound to the ? placeholders of the query
+        budget (QueryBudget): Time and row limits, the default limits if None.
+                              A query that runs out of time shows the rows it
+                              already found, or a message if it found none
     """
-    con = sqlite3.connect(db_path)
-
-    results = pd.read_sql_query(query, con)
-    con.close()
+    if budget is None:
+        budget = QueryBudget()
+
+    try:
+        with stage("execute"):
+            results = fetch_results(query, db_path, params, budget)
+    except QueryTooExpensive as e:
+        QUERIES_INTERRUPTED.inc(e.reason)
+        logger.warning("%s: %s %s", e, query, params)
+        return query, f"<p>{e}, try a more specific question.</p>\n"
+
+    if results.interrupted:
+        QUERIES_INTERRUPTED.inc(results.interrupted)
+    logger.info("Query returned %d rows: %s %s", len(results), query, params)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Query results:\n%s", results.to_string() if not results.empty else "(no rows)")
+
+    with stage("render"):
+        html = results.to_html()
+    if results.interrupted:
+        html += f"<p>The query took too long, showing the first {len(results)} rows</p>\n"
+    elif results.truncated:
+        html += f"<p>Showing the first {len(results)} rows</p>\n"
+
+    return query, html
+
+
+def fetch_results(query, db_path=DB_PATH, params=(), budget=None):
+    """
+    Executes a query and reads its rows without going through pandas.
+    Call to_dataframe on the result if a DataFrame is needed
 
-    print("\n----Query Results----")
-    if results.empty:
-        print("The query produced no results")
-    else:
-        print(results.to_string(index=False))
+    Argument:
+        query (string): The query to execute
+        db_path (string): Path to the database file
+        params (tuple): Parameters bound to the ? placeholders of the query
+        budget (QueryBudget): Optional time and row limits. A query stopped
+                              by it returns the rows read so far
 
-    print("\nResulting Query: ", query, "\n")
+    Returns:
+        QueryResult: Columns and rows of the result
 
-    return query, results.to_html()
+    Raises:
+        QueryTooExpensive: If the budget stopped the query before it returned any row
+    """
+    with get_pool(db_path).connection() as con:
+        if budget is None:
+            cur = con.execute(query, params)
+            try:
+                return QueryResult.from_cursor(cur)
+            finally:
+                cur.close()
+
+        with budget.attached(con):
+            return _fetch_within_budget(con, query, params, budget)
+
+
+def _fetch_within_budget(con, query, params, budget):
+    rows = []
+    columns = []
+    cur = None
+    try:
+        with budget.running():
+            cur = con.execute(query, params)
+        columns = [desc[0] for desc in cur.description or ()]
+
+        # extend keeps the rows it appended when the budget interrupts the read
+        limit = budget.row_limit
+        with budget.running():
+            rows.extend(cur if limit is None else islice(cur, limit + 1))
+    except Exception as e:
+        if not budget.interrupted(e):
+            raise
+        if not rows:
+            raise QueryTooExpensive(budget.reason) from e
+        return QueryResult(columns, rows, truncated=True, interrupted=budget.reason)
+    finally:
+        if cur is not None:
+            cur.close()
+
+    if limit is not None and len(rows) > limit:
+        return QueryResult(columns, rows[:limit], truncated=True)
+    return QueryResult(columns, rows)
+
+
+def stream_query(query, db_path=DB_PATH, params=(), fmt="html", batch_size=STREAM_BATCH_SIZE,
+                 max_rows=STREAM_MAX_ROWS, budget=None):
+    """
+    Executes a query and yields its results in chunks, reading the rows
+    in batches with fetchmany instead of loading the whole result set.
+    Nothing is printed to the console
 
+    Arguments:
+        query (string): The generated query
+        db_path (string): Path to the database file
+        params (tuple): Parameters bound to the ? placeholders of the query
+        fmt (string): Either "html" or "json"
+        batch_size (int): Number of rows fetched from SQLite at a time
+        max_rows (int): Most rows to deliver, the rest of the result is cut off
+        budget (QueryBudget): Time limit of the query and how to tell that the
+                              client went away, the default time limit if None.
+                              A stopped query ends the stream with what was
+                              sent so far and the reason it stopped
+
+    Yields:
+        string: Chunks of the HTML table or JSON document
+    """
+    if budget is None:
+        budget = QueryBudget()
+
+    # The stream is read at the pace of the client, so it doesn't hold a pooled connection
+    with get_pool(db_path).dedicated() as con, budget.attached(con):
+        cur = None
+        sent = 0
+        truncated = False
+        try:
+            with budget.running():
+                cur = con.execute(query, params)
+            columns = [desc[0] for desc in cur.description or ()]
+            yield _stream_header(columns, fmt)
+
+            while True:
+                with budget.running():
+                    rows = cur.fetchmany(min(batch_size, max_rows - sent + 1))
+                if sent + len(rows) > max_rows:
+                    rows = rows[:max_rows - sent]
+                    truncated = True
+
+                if rows:
+                    yield _stream_rows(rows, sent, fmt)
+                    sent += len(rows)
+
+                if truncated or len(rows) < batch_size:
+                    break
+        except Exception as e:
+            if not budget.interrupted(e):
+                raise
+            QUERIES_INTERRUPTED.inc(budget.reason)
+            if budget.reason == "cancelled":
+                return
+            if cur is None:
+                yield _stream_header([], fmt)
+            yield _stream_footer(sent, True, fmt, budget.reason)
+            return
+        finally:
+            if cur is not None:
+                cur.close()
+
+        yield _stream_footer(sent, truncated, fmt)
+
+
+def _stream_header(columns, fmt):
+    if fmt == "json":
+        return '{"columns": ' + json.dumps(columns) + ', "rows": ['
+
+    return html_table_start(columns)
+
+
+def _stream_rows(rows, start, fmt):
+    if fmt == "json":
+        chunk = ", ".join(json.dumps(list(row)) for row in rows)
+        return chunk if start == 0 else ", " + chunk
+
+    return html_table_rows(rows, start)
+
+
+def _stream_footer(row_count, truncated, fmt, interrupted=None):
+    if fmt == "json":
+        return ('], "row_count": ' + str(row_count) + ', "truncated": ' + json.dumps(truncated) +
+                ', "interrupted": ' + json.dumps(interrupted) + '}')
+
+    footer = html_table_end()
+    if interrupted and row_count == 0:
+        footer += "<p>The query took too long, try a more specific question.</p>\n"
+    elif interrupted:
+        footer += f"<p>The query took too long, showing the first {row_count} rows</p>\n"
+    elif truncated:
+        footer += f"<p>Showing the first {row_count} rows</p>\n"
+
+    return footer
@@ -1,6 +1,6 @@
-import sqlite3
 import os
 from data.database import DB_PATH, DB_DIR
+from data.schema_catalog import SCHEMA_CATALOG
 
 def get_column_and_tablenames(db_path=DB_PATH):
     """
@@ -13,15 +13,9 @@ def get_column_and_tablenames(db_path=DB_PATH):
         column_names (list): List of all column names
         table_names (list): List of all table names
     """
-    schema = get_schema_info(db_path)
-    column_names = set()
-    table_names = set(schema.keys())
+    entry = SCHEMA_CATALOG.get(db_path)
 
-    for table in schema.items():
-        for col in table[1]:
-            column_names.add(col)
-
-    return list(column_names), list(table_names)
+    return list(entry.columns), list(entry.tables)
 
 
 def get_column_types(table, db_path=DB_PATH):
@@ -35,18 +29,9 @@ def get_column_types(table, db_path=DB_PATH):
     Returns:
         dict: Dictionary mapping column names to their types
     """
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-
-    column_types = {}
+    entry = SCHEMA_CATALOG.get(db_path)
 
-    cur.execute(f"PRAGMA table_info({table})")
-    column_info = cur.fetchall()
-    for col_info in column_info:
-        column_types[col_info[1]] = col_info[2].upper()
-
-    con.close()
-    return column_types
+    return dict(entry.types.get(table, {}))
 
 def column_is_number(column_type):
     """
@@ -64,7 +49,7 @@ def column_is_number(column_type):
 
 def get_schema_info(db_path=DB_PATH):
     """
-    Connects to a database and returns its schema info
+    Returns the schema info of a database from the schema catalog
 
     Argument:
         db_path (string): Path to the database file
@@ -73,24 +58,9 @@ def get_schema_info(db_path=DB_PATH):
         dict: A dictionary where the keys are the table names and the
               values are the table's columns
     """
-    schema = {}
-
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
+    entry = SCHEMA_CATALOG.get(db_path)
 
-    query = "SELECT name FROM sqlite_master WHERE type='table';"
-    cur.execute(query)
-
-    tables = [row[0] for row in cur.fetchall()]
-
-    for table in tables:
-        cur.execute(f"PRAGMA table_info({table})")
-        column_names = [column[1] for column in cur.fetchall()]
-        
-        schema[table] = column_names
-
-    con.close()
-    return schema
+    return {table: list(cols) for table, cols in entry.tables.items()}
 
 def get_available_dbs():
     """
@@ -103,12 +73,7 @@ def get_available_dbs():
         os.mkdir(DB_DIR)
         return []
     
-    dbs = []
-    for file in os.listdir(DB_DIR):
-        if file.endswith('.db'):
-            dbs.append(file)
-
-    return dbs
+    return SCHEMA_CATALOG.list_databases(DB_DIR)
 
 def get_db_path(db):
     """
@@ -0,0 +1,274 @@
+import csv
+import logging
+import sqlite3
+import time
+from itertools import chain, islice
+from data.database import DB_PATH
+
+# Rows inserted per transaction
+LOAD_BATCH_SIZE = 10000
+
+# Rows looked at to infer the type of each column
+TYPE_SAMPLE_SIZE = 1000
+
+# Pragmas that speed up bulk inserts; the database is only written by the loader meanwhile.
+# They only last as long as the loader's connection, unlike journal_mode which
+# would stay changed in the database file
+LOADER_PRAGMAS = {
+    "synchronous": "OFF",
+    "cache_size": -256 * 1024,
+    "temp_store": "MEMORY",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def quote_identifier(name):
+    """
+    Quote a table or column name for use in SQL
+
+    Argument:
+        name (string): The name
+
+    Returns:
+        string: The quoted name
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def infer_column_types(rows, column_count):
+    """
+    Infer the SQLite type of each column from a sample of rows.
+    A column is INTEGER if every non-empty value is an integer, REAL if
+    every non-empty value is a number and TEXT otherwise
+
+    Arguments:
+        rows (list): Sample of rows read from the CSV file
+        column_count (int): Number of columns
+
+    Returns:
+        list: Type of each column
+    """
+    types = []
+    for idx in range(column_count):
+        col_type = "INTEGER"
+        for row in rows:
+            value = row[idx].strip() if idx < len(row) else ""
+            if value == "":
+                continue
+            if col_type == "INTEGER" and not _is_integer(value):
+                col_type = "REAL"
+            if col_type == "REAL" and not _is_real(value):
+                col_type = "TEXT"
+                break
+        types.append(col_type)
+
+    return types
+
+
+def load_csv(csv_path, table, db_path=DB_PATH, batch_size=LOAD_BATCH_SIZE, sample_size=TYPE_SAMPLE_SIZE,
+             index_columns=(), column_types=None, id_column=None, replace=True,
+             filter_columns=(), filter_index="lower", fts_columns=(), not_null=()):
+    """
+    Load a CSV file with a header row into a table. The file is streamed
+    and inserted in batches, one transaction per batch, so it never has
+    to fit in memory. Indexes are built once all rows are in
+
+    Arguments:
+        csv_path (string): Path to the CSV file
+        table (string): Name of the table to load into
+        db_path (string): Path to the database file
+        batch_size (int): Number of rows inserted per transaction
+        sample_size (int): Number of rows used to infer the column types
+        index_columns (list): Columns to index after the load
+        column_types (dict): Column name -> type, overriding the inferred types
+        id_column (string): If given, an INTEGER PRIMARY KEY AUTOINCREMENT column added first
+        replace (bool): Drop the table and its full-text index first if they already exist
+        filter_columns (list): Text columns that get filtered on. They get an index
+                               matching the case-insensitive filters of the translator
+        filter_index (string): "lower" for LOWER(col) expression indexes, or "nocase"
+                               to declare the columns COLLATE NOCASE and index them
+        fts_columns (list): Text columns to put in an FTS5 full-text index
+        not_null (list): Columns declared NOT NULL
+
+    Returns:
+        dict: Number of rows loaded, seconds taken and rows per second
+    """
+    start = time.perf_counter()
+
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        for name, value in LOADER_PRAGMAS.items():
+            con.execute(f"PRAGMA {name} = {value}")
+
+        with open(csv_path, newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            sample = list(islice(reader, sample_size))
+
+            types = infer_column_types(sample, len(header))
+            if column_types:
+                types = [column_types.get(col, col_type) for col, col_type in zip(header, types)]
+
+            collations = {}
+            if filter_index == "nocase":
+                collations = {col: "NOCASE" for col in filter_columns}
+            _create_table(con, table, header, types, id_column, replace, collations, not_null)
+
+            columns = ", ".join(quote_identifier(col) for col in header)
+            slots = ", ".join("?" for _ in header)
+            insert = f"INSERT INTO {quote_identifier(table)} ({columns}) VALUES({slots})"
+
+            rows = chain(sample, reader)
+            row_count = 0
+            while True:
+                batch = [_convert_row(row, types) for row in islice(rows, batch_size)]
+                if not batch:
+                    break
+
+                con.execute("BEGIN")
+                con.executemany(insert, batch)
+                con.execute("COMMIT")
+                row_count += len(batch)
+
+        for col in index_columns:
+            con.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(f'idx_{table}_{col}')} "
+                        f"ON {quote_identifier(table)}({quote_identifier(col)})")
+        _create_filter_indexes(con, table, filter_columns, filter_index)
+        if fts_columns:
+            _create_fts_index(con, table, fts_columns)
+        con.execute("ANALYZE")
+    finally:
+        con.close()
+
+    seconds = time.perf_counter() - start
+    stats = {"rows": row_count, "seconds": seconds, "rows_per_sec": row_count / seconds if seconds else 0.0}
+    logger.info("Loaded %d rows into %s in %.2fs (%.0f rows/sec)", row_count, table, seconds, stats["rows_per_sec"])
+
+    return stats
+
+
+def create_filter_indexes(db_path, table, columns, mode="lower"):
+    """
+    Index text columns of an existing table so that the case-insensitive
+    filters made by the translator become index seeks
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the table
+        columns (list): Text columns that get filtered on
+        mode (string): "lower" for LOWER(col) expression indexes, matching
+                       `LOWER(col) = value`, or "nocase" for COLLATE NOCASE
+                       indexes, matching `col = value COLLATE NOCASE`
+    """
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        _create_filter_indexes(con, table, columns, mode)
+        con.execute("ANALYZE")
+    finally:
+        con.close()
+
+
+def build_fts_index(db_path, table, columns=None):
+    """
+    Build an FTS5 full-text index over text columns of a table, so that
+    "containing" filters become a MATCH lookup instead of a LIKE scan.
+    The index is an external-content table named `<table>_fts`, kept in
+    sync with the table by triggers
+
+    Arguments:
+        db_path (string): Path to the database file
+        table (string): Name of the table
+        columns (list): Columns to index, or None for every TEXT column
+    """
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        if columns is None:
+            columns = [col_info[1] for col_info in con.execute(f"PRAGMA table_info({quote_identifier(table)})")
+                       if col_info[2].upper() == "TEXT"]
+        _create_fts_index(con, table, columns)
+    finally:
+        con.close()
+
+
+def _create_fts_index(con, table, columns):
+    fts = f"{table}_fts"
+    quoted_table = quote_identifier(table)
+    quoted_fts = quote_identifier(fts)
+    cols = ", ".join(quote_identifier(col) for col in columns)
+    new_values = ", ".join("new." + quote_identifier(col) for col in columns)
+    old_values = ", ".join("old." + quote_identifier(col) for col in columns)
+    content = table.replace("'", "''")
+
+    con.execute("BEGIN")
+    con.execute(f"DROP TABLE IF EXISTS {quoted_fts}")
+    con.execute(f"CREATE VIRTUAL TABLE {quoted_fts} USING fts5({cols}, content='{content}', content_rowid='rowid')")
+    con.execute(f"INSERT INTO {quoted_fts}({quoted_fts}) VALUES('rebuild')")
+
+    con.execute(f"DROP TRIGGER IF EXISTS {quote_identifier(fts + '_ai')}")
+    con.execute(f"DROP TRIGGER IF EXISTS {quote_identifier(fts + '_ad')}")
+    con.execute(f"DROP TRIGGER IF EXISTS {quote_identifier(fts + '_au')}")
+    con.execute(f"CREATE TRIGGER {quote_identifier(fts + '_ai')} AFTER INSERT ON {quoted_table} BEGIN "
+                f"INSERT INTO {quoted_fts}(rowid, {cols}) VALUES(new.rowid, {new_values}); END")
+    con.execute(f"CREATE TRIGGER {quote_identifier(fts + '_ad')} AFTER DELETE ON {quoted_table} BEGIN "
+                f"INSERT INTO {quoted_fts}({quoted_fts}, rowid, {cols}) VALUES('delete', old.rowid, {old_values}); END")
+    con.execute(f"CREATE TRIGGER {quote_identifier(fts + '_au')} AFTER UPDATE ON {quoted_table} BEGIN "
+                f"INSERT INTO {quoted_fts}({quoted_fts}, rowid, {cols}) VALUES('delete', old.rowid, {old_values}); "
+                f"INSERT INTO {quoted_fts}(rowid, {cols}) VALUES(new.rowid, {new_values}); END")
+    con.execute("COMMIT")
+
+
+def _create_filter_indexes(con, table, columns, mode):
+    for col in columns:
+        if mode == "nocase":
+            name = f"idx_{table}_{col}_nocase"
+            key = f"{quote_identifier(col)} COLLATE NOCASE"
+        else:
+            name = f"idx_{table}_{col}_lower"
+            key = f"LOWER({quote_identifier(col)})"
+
+        con.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(name)} ON {quote_identifier(table)}({key})")
+
+
+def _create_table(con, table, header, types, id_column, replace, collations=None, not_null=()):
+    collations = collations or {}
+    columns = [f"{quote_identifier(col)} {col_type}" + (" NOT NULL" if col in not_null else "")
+               + (f" COLLATE {collations[col]}" if col in collations else "")
+               for col, col_type in zip(header, types)]
+    if id_column:
+        columns.insert(0, f"{quote_identifier(id_column)} INTEGER PRIMARY KEY AUTOINCREMENT")
+
+    if replace:
+        con.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+        # The full-text index outlives its triggers and would still point at the old rowids,
+        # load_csv builds a new one if fts_columns are given
+        con.execute(f"DROP TABLE IF EXISTS {quote_identifier(table + '_fts')}")
+    con.execute(f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({', '.join(columns)})")
+
+
+def _convert_row(row, types):
+    # Missing and empty values of number columns become NULL instead of ''
+    values = []
+    for idx, col_type in enumerate(types):
+        value = row[idx] if idx < len(row) else None
+        if value == "" and col_type != "TEXT":
+            value = None
+        values.append(value)
+
+    return values
+
+
+def _is_integer(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_real(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
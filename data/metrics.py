@@ -0,0 +1,271 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+# Stages a request goes through, in order
+STAGES = ("tokenize", "lemmatize", "resolve", "parse", "translate", "execute", "render")
+
+_current_request = ContextVar("current_request", default=None)
+
+
+class Counter:
+    """
+    Prometheus counter, optionally split by labels
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increase the counter
+
+        Arguments:
+            label_values (string): Value of each label, in order
+            amount (float): How much to add
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, label_values, value) for label_values, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """
+    Prometheus histogram, optionally split by labels
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Record one measurement
+
+        Arguments:
+            value (float): The measurement
+            label_values (string): Value of each label, in order
+        """
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum of the measurements
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+
+        for label_values, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((self.name + "_bucket", label_values + (le,), total))
+            samples.append((self.name + "_sum", label_values, counts[-1]))
+            samples.append((self.name + "_count", label_values, total))
+
+        return samples
+
+
+class Registry:
+    """
+    Set of metrics rendered together in the Prometheus text format.
+    Each process has its own, so with several workers every worker
+    reports what it served itself
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        Add a function that is called on every render and returns
+        (name, help, kind, [(label dict, value)]) tuples, for numbers
+        that are kept somewhere else
+
+        Argument:
+            collect (callable): The function
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format
+
+        Returns:
+            string: The metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            label_names = metric.labels + (("le",) if metric.kind == "histogram" else ())
+            for name, label_values, value in metric.samples():
+                lines.append(name + _format_labels(zip(label_names, label_values)) + " " + _format_value(value))
+
+        for collect in self._collectors:
+            for name, help, kind, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(name + _format_labels(labels.items()) + " " + _format_value(value))
+
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """
+    What happened while serving one request: the time spent in each
+    stage and details about the sentence and the query
+
+    Attributes:
+        endpoint (string): Name of the endpoint
+        stages (dict): Stage name -> seconds spent in it
+        info (dict): Details recorded along the way, like the sentence and the SQL
+        started (float): perf_counter value when the request started
+        seconds (float): How long the request took, set when it ends
+    """
+    __slots__ = ("endpoint", "stages", "info", "started", "seconds")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.info = {}
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def as_dict(self):
+        return {"endpoint": self.endpoint, "seconds": self.seconds,
+                "stages": {name: self.stages[name] for name in STAGES if name in self.stages}, **self.info}
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram("naturalsql_request_seconds", "Time taken to serve a request", ["endpoint"])
+STAGE_SECONDS = REGISTRY.histogram("naturalsql_stage_seconds", "Time taken by each stage of a request", ["stage"])
+PARSE_FAILURES = REGISTRY.counter("naturalsql_parse_failures_total", "Sentences that could not be translated",
+                                  ["reason"])
+CACHE_HITS = REGISTRY.counter("naturalsql_cache_hits_total", "Lookups answered from a cache", ["cache"])
+CACHE_MISSES = REGISTRY.counter("naturalsql_cache_misses_total", "Lookups a cache could not answer", ["cache"])
+QUERIES_INTERRUPTED = REGISTRY.counter("naturalsql_queries_interrupted_total",
+                                       "Queries stopped by their time budget or cancelled", ["reason"])
+
+
+@contextmanager
+def track_request(endpoint):
+    """
+    Time a request and collect the stages it goes through
+
+    Argument:
+        endpoint (string): Name of the endpoint
+
+    Yields:
+        RequestMetrics: The metrics of the request
+    """
+    request = RequestMetrics(endpoint)
+    token = _current_request.set(request)
+    try:
+        yield request
+    finally:
+        _current_request.reset(token)
+        request.seconds = time.perf_counter() - request.started
+        REQUEST_SECONDS.observe(request.seconds, endpoint)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage, adding it to the stage histogram and to the current request
+
+    Argument:
+        name (string): Name of the stage, one of STAGES
+    """
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - began
+        STAGE_SECONDS.observe(seconds, name)
+        request = _current_request.get()
+        if request is not None:
+            request.stages[name] = request.stages.get(name, 0.0) + seconds
+
+
+def current_request():
+    """
+    Get the metrics of the request being served
+
+    Returns:
+        RequestMetrics: The metrics, or None outside of a tracked request
+    """
+    return _current_request.get()
+
+
+def record(**info):
+    """
+    Add details to the request being served, if any
+
+    Arguments:
+        info: Names and values to record
+    """
+    request = _current_request.get()
+    if request is not None:
+        request.info.update(info)
+
+
+def _format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,108 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# Seconds a query may spend in SQLite
+QUERY_TIME_LIMIT = 5.0
+
+# Most rows a query result will contain
+QUERY_ROW_LIMIT = 10000
+
+# SQLite virtual machine instructions between two budget checks
+PROGRESS_STEPS = 10000
+
+# Seconds between two checks of whether the client is still there
+CANCEL_CHECK_INTERVAL = 0.25
+
+
+class QueryTooExpensive(Exception):
+    """
+    Raised when a query is stopped before it produced any row
+
+    Attributes:
+        reason (string): "time" if it ran out of time, "cancelled" if it was cancelled
+    """
+    def __init__(self, reason):
+        super().__init__("The query took too long" if reason == "time" else "The query was cancelled")
+        self.reason = reason
+
+
+class QueryBudget:
+    """
+    Time and row limits of a query. While attached to a connection,
+    SQLite's progress handler checks the budget every PROGRESS_STEPS
+    instructions and interrupts the query once the time is up or
+    `is_cancelled` says nobody is waiting for the result anymore.
+
+    Only time spent inside SQLite counts, so a streamed result isn't
+    cut off because the client reads it slowly
+
+    Attributes:
+        time_limit (float): Seconds the query may run, or None for no limit
+        row_limit (int): Most rows to read, or None for no limit
+        is_cancelled (callable): Returns True once the query should stop
+        used (float): Seconds spent in SQLite so far
+        reason (string): Why the query was interrupted, or None
+    """
+    def __init__(self, time_limit=QUERY_TIME_LIMIT, row_limit=QUERY_ROW_LIMIT, is_cancelled=None):
+        self.time_limit = time_limit
+        self.row_limit = row_limit
+        self.is_cancelled = is_cancelled
+        self.used = 0.0
+        self.reason = None
+
+        self._started = None
+        self._last_cancel_check = 0.0
+
+    @contextmanager
+    def attached(self, con):
+        """
+        Enforce the budget on a connection until the block ends
+
+        Argument:
+            con (Connection): Connection running the query
+        """
+        con.set_progress_handler(self._progress, PROGRESS_STEPS)
+        try:
+            yield
+        finally:
+            con.set_progress_handler(None, 0)
+
+    @contextmanager
+    def running(self):
+        """
+        Count the time spent in the block against the budget
+        """
+        self._started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.used += time.perf_counter() - self._started
+            self._started = None
+
+    def interrupted(self, error):
+        """
+        Tell whether an error was raised because the budget interrupted the query
+
+        Argument:
+            error (Exception): Error raised by SQLite
+
+        Returns:
+            bool: True if the budget stopped the query
+        """
+        return self.reason is not None and isinstance(error, sqlite3.OperationalError)
+
+    def _progress(self):
+        now = time.perf_counter()
+        if self.time_limit is not None and self._started is not None:
+            if self.used + now - self._started > self.time_limit:
+                self.reason = "time"
+                return 1
+
+        if self.is_cancelled is not None and now - self._last_cancel_check >= CANCEL_CHECK_INTERVAL:
+            self._last_cancel_check = now
+            if self.is_cancelled():
+                self.reason = "cancelled"
+                return 1
+
+        return 0
@@ -0,0 +1,135 @@
+import html
+import json
+
+
+class QueryResult:
+    """
+    Rows returned by a query, read straight from the cursor.
+    Has its own HTML, text and JSON renderers so that pandas is only
+    needed when a DataFrame is explicitly asked for
+
+    Attributes:
+        columns (list): Names of the result columns
+        rows (list): List of row tuples
+        truncated (bool): True if rows were left out of the result
+        interrupted (string): Why the query was stopped before it finished
+                              ("time" or "cancelled"), or None
+    """
+    __slots__ = ("columns", "rows", "truncated", "interrupted")
+
+    def __init__(self, columns, rows, truncated=False, interrupted=None):
+        self.columns = columns
+        self.rows = rows
+        self.truncated = truncated
+        self.interrupted = interrupted
+
+    @classmethod
+    def from_cursor(cls, cur):
+        """
+        Read every row of an executed cursor
+
+        Argument:
+            cur (Cursor): Cursor that executed a query
+
+        Returns:
+            QueryResult: The rows of the cursor
+        """
+        columns = [desc[0] for desc in cur.description or ()]
+        return cls(columns, cur.fetchall())
+
+    @property
+    def empty(self):
+        return not self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def to_html(self):
+        """
+        Render the result as an HTML table laid out like DataFrame.to_html
+
+        Returns:
+            string: HTML table
+        """
+        return html_table_start(self.columns) + html_table_rows(self.rows) + html_table_end()
+
+    def to_string(self):
+        """
+        Render the result as a plain text table with right aligned columns
+
+        Returns:
+            string: Text table
+        """
+        cells = [[str(col) for col in self.columns]]
+        cells += [[str(value) for value in row] for row in self.rows]
+        widths = [max(len(line[i]) for line in cells) for i in range(len(self.columns))]
+
+        return "\n".join(" ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+    def to_json(self):
+        """
+        Render the result as a JSON document
+
+        Returns:
+            string: JSON with the columns, rows and whether rows were cut off
+        """
+        return json.dumps({"columns": self.columns, "rows": [list(row) for row in self.rows],
+                           "row_count": len(self.rows), "truncated": self.truncated,
+                           "interrupted": self.interrupted})
+
+    def to_dataframe(self):
+        """
+        Convert the result to a pandas DataFrame, importing pandas on demand
+
+        Returns:
+            DataFrame: The rows of the result
+        """
+        import pandas as pd
+        return pd.DataFrame.from_records(self.rows, columns=self.columns)
+
+
+def html_table_start(columns):
+    """
+    Opening of an HTML result table up to its first row
+
+    Argument:
+        columns (list): Names of the result columns
+
+    Returns:
+        string: HTML
+    """
+    cells = "".join(f"\n      <th>{html.escape(str(col))}</th>" for col in columns)
+    return ('<table border="1" class="dataframe">\n  <thead>\n    <tr style="text-align: right;">\n'
+            f'      <th></th>{cells}\n    </tr>\n  </thead>\n  <tbody>\n')
+
+
+def html_table_rows(rows, start=0):
+    """
+    Rows of an HTML result table
+
+    Arguments:
+        rows (list): List of row tuples
+        start (int): Row number of the first row
+
+    Returns:
+        string: HTML
+    """
+    lines = []
+    for idx, row in enumerate(rows, start):
+        cells = "".join(f"\n      <td>{html.escape(str(value))}</td>" for value in row)
+        lines.append(f"    <tr>\n      <th>{idx}</th>{cells}\n    </tr>\n")
+
+    return "".join(lines)
+
+
+def html_table_end():
+    """
+    Closing of an HTML result table
+
+    Returns:
+        string: HTML
+    """
+    return "  </tbody>\n</table>\n"
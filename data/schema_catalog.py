@@ -0,0 +1,241 @@
+import hashlib
+import os
+import re
+import threading
+from data.connection_pool import get_pool
+from data.database import DB_PATH, DB_DIR
+
+# Tables FTS5 creates next to each full-text index
+FTS_SHADOW_SUFFIXES = ("_data", "_idx", "_docsize", "_config", "_content")
+
+
+class SchemaEntry:
+    """
+    Snapshot of the schema of a single database file
+
+    Attributes:
+        tables (dict): Maps table names to a tuple of their column names
+        types (dict): Maps table names to a dict of column name -> column type
+        nocase (dict): Maps table names to the frozenset of their columns that lead
+                       a COLLATE NOCASE index
+        fts (dict): Maps table names to (FTS5 table name, indexed columns) of their
+                    full-text index
+        columns (tuple): Every column name in the database, without duplicates
+        schema_version (int): Value of PRAGMA schema_version when read
+        stamp (tuple): File stamp used to detect changes to the database file
+        fingerprint (string): Hash of the schema, stable across processes
+    """
+    __slots__ = ("tables", "types", "nocase", "fts", "columns", "schema_version", "stamp", "fingerprint")
+
+    def __init__(self, tables, types, schema_version, stamp, nocase=None, fts=None):
+        self.tables = tables
+        self.types = types
+        self.nocase = nocase if nocase is not None else {}
+        self.fts = fts if fts is not None else {}
+        self.schema_version = schema_version
+        self.stamp = stamp
+
+        columns = {}
+        for cols in tables.values():
+            for col in cols:
+                columns.setdefault(col, None)
+        self.columns = tuple(columns)
+
+        digest = hashlib.sha1()
+        for table in sorted(tables):
+            digest.update(table.encode())
+            for col in tables[table]:
+                digest.update(b"\0" + col.encode() + b":" + types[table][col].encode())
+                if col in self.nocase.get(table, ()):
+                    digest.update(b":nocase")
+            if table in self.fts:
+                fts_table, fts_columns = self.fts[table]
+                digest.update(b"\0fts:" + fts_table.encode() + b":" + ",".join(fts_columns).encode())
+            digest.update(b"\n")
+        self.fingerprint = digest.hexdigest()
+
+
+class SchemaCatalog:
+    """
+    Process-wide cache of the tables, columns and column types of each database.
+
+    An entry is only re-read when the database file (or its WAL file) changes on
+    disk, and the full schema is only re-read when PRAGMA schema_version says the
+    schema itself changed, so lookups in steady state do no database I/O.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._db_lists = {}
+        self._lock = threading.Lock()
+
+    def get(self, db_path=DB_PATH):
+        """
+        Get the schema of a database, reading it only if it changed
+
+        Argument:
+            db_path (string): Path to the database file
+
+        Returns:
+            SchemaEntry: The cached schema of the database
+        """
+        key = os.path.abspath(db_path)
+        stamp = _file_stamp(key)
+        entry = self._entries.get(key)
+        if entry is not None and stamp is not None and entry.stamp == stamp:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and stamp is not None and entry.stamp == stamp:
+                return entry
+
+            with get_pool(db_path).connection() as con:
+                version = con.execute("PRAGMA schema_version").fetchone()[0]
+                if entry is not None and entry.schema_version == version:
+                    # Only the data changed, the schema we have is still valid
+                    entry.stamp = _file_stamp(key)
+                    return entry
+
+                entry = _read_schema(con, version, _file_stamp(key))
+
+            self._entries[key] = entry
+
+        return entry
+
+    def list_databases(self, db_dir=DB_DIR):
+        """
+        Get list of db files in a directory, re-listing it only when
+        the directory changed
+
+        Argument:
+            db_dir (string): Directory containing the database files
+
+        Returns:
+            list: List of db file names
+        """
+        mtime = os.stat(db_dir).st_mtime_ns
+        cached = self._db_lists.get(db_dir)
+        if cached is None or cached[0] != mtime:
+            dbs = tuple(file for file in os.listdir(db_dir) if file.endswith('.db'))
+            cached = (mtime, dbs)
+            self._db_lists[db_dir] = cached
+
+        return list(cached[1])
+
+    def invalidate(self, db_path=None):
+        """
+        Drop cached schemas so that they are read again on next use
+
+        Argument:
+            db_path (string): Path to the database file, or None to drop everything
+        """
+        with self._lock:
+            if db_path is None:
+                self._entries.clear()
+                self._db_lists.clear()
+            else:
+                self._entries.pop(os.path.abspath(db_path), None)
+
+
+def _file_stamp(path):
+    """
+    Cheap change marker for a database file. The WAL file is included
+    because schema changes in WAL mode do not touch the main file until
+    a checkpoint
+
+    Argument:
+        path (string): Path to the database file
+
+    Returns:
+        tuple: Modification times and sizes, or None if the file doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    try:
+        wal = os.stat(path + "-wal")
+        wal_stamp = (wal.st_mtime_ns, wal.st_size)
+    except OSError:
+        wal_stamp = None
+
+    return (st.st_mtime_ns, st.st_size, wal_stamp)
+
+
+def _read_schema(con, version, stamp):
+    """
+    Read every table, column and column type in one pass
+
+    Arguments:
+        con (Connection): Open connection to the database
+        version (int): Current schema_version of the database
+        stamp (tuple): File stamp of the database
+
+    Returns:
+        SchemaEntry: The schema of the database
+    """
+    cur = con.cursor()
+    # Internal tables like sqlite_sequence and sqlite_stat1 are not part of the user's schema
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\';")
+    rows = cur.fetchall()
+
+    # Full-text indexes and their shadow tables aren't tables users ask about either
+    fts = {}
+    hidden = set()
+    for name, sql in rows:
+        if sql and re.search(r"USING\s+fts5", sql, re.IGNORECASE):
+            content = re.search(r"content\s*=\s*['\"]?([^'\",)\s]+)", sql, re.IGNORECASE)
+            base = content.group(1) if content else name[:-len("_fts")] if name.endswith("_fts") else None
+            quoted = name.replace('"', '""')
+            cur.execute(f'PRAGMA table_info("{quoted}")')
+            if base:
+                fts[base] = (name, tuple(col_info[1] for col_info in cur.fetchall()))
+            hidden.add(name)
+            hidden.update(name + suffix for suffix in FTS_SHADOW_SUFFIXES)
+
+    table_names = [name for name, sql in rows if name not in hidden]
+    fts = {base: index for base, index in fts.items() if base in table_names}
+
+    tables = {}
+    types = {}
+    nocase = {}
+    for table in table_names:
+        quoted = table.replace('"', '""')
+        cur.execute(f'PRAGMA table_info("{quoted}")')
+        column_info = cur.fetchall()
+
+        tables[table] = tuple(col_info[1] for col_info in column_info)
+        types[table] = {col_info[1]: col_info[2].upper() for col_info in column_info}
+        nocase[table] = _read_nocase_columns(cur, quoted)
+
+    return SchemaEntry(tables, types, version, stamp, nocase, fts)
+
+
+def _read_nocase_columns(cur, quoted_table):
+    """
+    Find the columns of a table that are the first key of a COLLATE NOCASE
+    index, so that case-insensitive filters on them can use the index
+
+    Arguments:
+        cur (Cursor): Cursor on the database
+        quoted_table (string): Name of the table with its double quotes escaped
+
+    Returns:
+        frozenset: Names of the columns
+    """
+    columns = set()
+    cur.execute(f'PRAGMA index_list("{quoted_table}")')
+    for index_info in cur.fetchall():
+        quoted_index = index_info[1].replace('"', '""')
+        cur.execute(f'PRAGMA index_xinfo("{quoted_index}")')
+        first_key = cur.fetchone()
+        cur.fetchall()
+        if first_key and first_key[1] >= 0 and (first_key[4] or "").upper() == "NOCASE":
+            columns.add(first_key[2])
+
+    return frozenset(columns)
+
+
+SCHEMA_CATALOG = SchemaCatalog()
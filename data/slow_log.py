@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from data.connection_pool import get_pool
+
+# Requests that take longer than this many seconds are logged
+SLOW_REQUEST_THRESHOLD = 1.0
+
+# Each process writes its own file, as workers sharing one would lose
+# lines whenever one of them rotates it
+SLOW_LOG_PATH = "logs/slow_queries.{pid}.jsonl"
+
+# Size a slow-query log file grows to before it is rotated, and how many old files are kept
+SLOW_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_LOG_BACKUPS = 5
+
+
+class SlowQueryLog:
+    """
+    Writes requests slower than a threshold to a rotating JSONL file, one
+    object per line with the sentence, its tokens, the SQL, the time spent
+    in each stage and the EXPLAIN QUERY PLAN of the query, so that the
+    sentence shapes that end up scanning whole tables can be found
+
+    Attributes:
+        path (string): Path of the log file. "{pid}" in it is replaced with
+                       the id of the process, giving each worker its own file.
+                       Without it, only one process may write to the file
+        threshold (float): Requests taking at least this many seconds are logged
+        logged (int): Number of requests logged by this process
+    """
+    def __init__(self, path=SLOW_LOG_PATH, threshold=SLOW_REQUEST_THRESHOLD, max_bytes=SLOW_LOG_MAX_BYTES,
+                 backups=SLOW_LOG_BACKUPS):
+        self.path = path
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.logged = 0
+
+        self._handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def check(self, metrics, db_path):
+        """
+        Log a request if it was slow
+
+        Arguments:
+            metrics (RequestMetrics): Metrics of the finished request
+            db_path (string): Path to the database the request was about
+
+        Returns:
+            bool: True if the request was logged
+        """
+        if metrics.seconds is None or metrics.seconds < self.threshold:
+            return False
+
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "db": os.path.basename(db_path), **metrics.as_dict()}
+        sql = metrics.info.get("sql")
+        if sql:
+            try:
+                entry["plan"] = explain_query_plan(sql, db_path, metrics.info.get("params", ()))
+                entry["full_scan"] = any(uses_full_scan(step["detail"]) for step in entry["plan"])
+            except Exception as e:
+                entry["plan_error"] = str(e)
+
+        self.write(entry)
+        return True
+
+    def write(self, entry):
+        """
+        Append an entry to the log file
+
+        Argument:
+            entry (dict): The entry
+        """
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            # Opened on first use so that forked workers each get their own handle
+            if self._handler is None or self._pid != os.getpid():
+                path = self.path.format(pid=os.getpid())
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._handler = RotatingFileHandler(path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                                    encoding="utf-8")
+                self._handler.setFormatter(logging.Formatter("%(message)s"))
+                self._pid = os.getpid()
+
+            self._handler.emit(logging.makeLogRecord({"msg": line, "levelno": logging.WARNING,
+                                                      "levelname": "WARNING"}))
+            self.logged += 1
+
+    def close(self):
+        with self._lock:
+            if self._handler is not None:
+                self._handler.close()
+                self._handler = None
+
+
+def explain_query_plan(query, db_path, params=()):
+    """
+    Get the plan SQLite uses for a query
+
+    Arguments:
+        query (string): The query
+        db_path (string): Path to the database file
+        params (tuple): Parameters bound to the ? placeholders of the query
+
+    Returns:
+        list: One dict per step of the plan with its id, parent id and detail
+    """
+    with get_pool(db_path).connection() as con:
+        rows = con.execute("EXPLAIN QUERY PLAN " + query.rstrip().rstrip(";"), tuple(params)).fetchall()
+
+    return [{"id": row[0], "parent": row[1], "detail": row[3]} for row in rows]
+
+
+def uses_full_scan(detail):
+    """
+    Tell whether a step of a query plan reads a whole table
+
+    Argument:
+        detail (string): Detail of the step
+
+    Returns:
+        bool: True for a table scan that doesn't go through an index
+    """
+    return detail.startswith("SCAN ") and " USING " not in detail
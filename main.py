@@ -1,6 +1,13 @@
+import time
+START = time.perf_counter()
+
+import argparse
+import logging
+import os
 from data.db_utils import *
+from data.slow_log import SLOW_LOG_PATH, SLOW_REQUEST_THRESHOLD, SlowQueryLog
 from NLP.parser import *
-from GUI.main_ui import *
+from NLP.warmup import StartupTimer, start_warm_up, warm_up
 
 def taking_question():
     """
@@ -19,17 +26,60 @@ def taking_question():
 
 
 
+def parse_args():
+    """
+    Read the command line options
+
+    Returns:
+        Namespace: host, port, number of workers and logging options
+    """
+    arg_parser = argparse.ArgumentParser(description="Natural language to SQL web interface")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    arg_parser.add_argument("--port", type=int, default=5000, help="port to listen on")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="number of pre-forked worker processes, 1 runs the development server")
+    arg_parser.add_argument("--log-level", default=os.environ.get("NATURALSQL_LOG_LEVEL", "INFO"),
+                            help="DEBUG, INFO, WARNING or ERROR; DEBUG also logs query results")
+    arg_parser.add_argument("--slow-threshold", type=float,
+                            default=float(os.environ.get("NATURALSQL_SLOW_THRESHOLD", SLOW_REQUEST_THRESHOLD)),
+                            help="log requests taking at least this many seconds, a negative value turns it off")
+    arg_parser.add_argument("--slow-log", default=os.environ.get("NATURALSQL_SLOW_LOG", SLOW_LOG_PATH),
+                            help="JSONL file slow requests are written to, {pid} is replaced with the id of "
+                                 "the worker writing it and is required with more than one worker")
+    args = arg_parser.parse_args()
+    if args.workers > 1 and args.slow_threshold >= 0 and "{pid}" not in args.slow_log:
+        arg_parser.error("--slow-log needs {pid} in its path when there is more than one worker")
+    return args
+
+
 def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    timer = StartupTimer(START)
+    timer.record("imports", time.perf_counter() - START)
+
+    parsers = ParserRegistry()
+    if args.workers > 1:
+        # Workers are forked from this process, so load everything first and let them share it
+        warm_up(parsers=parsers, timer=timer)
+        logging.getLogger(__name__).info("%s", timer.report())
+    else:
+        # Load nltk, WordNet, the schema and the parser while the server starts
+        start_warm_up(parsers=parsers, timer=timer)
+
     schema = get_schema_info()
     print("List of tables")
     print("---------------")
     print("--".join(key for key in schema.keys()))
 
     #taking_question()
-    main_ui = MainGUI(parser= init_parser())
-    main_ui.run_ui()
+    with timer.phase("flask"):
+        from GUI.main_ui import MainGUI
+        slow_log = SlowQueryLog(args.slow_log, args.slow_threshold) if args.slow_threshold >= 0 else None
+        main_ui = MainGUI(parsers= parsers, slow_log=slow_log)
+    main_ui.run_ui(args.host, args.port, args.workers)
     print("Ending program")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
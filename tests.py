@@ -1,5 +1,31 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from NLP.parser import preprocess, process, init_parser
+from unittest import mock
+from NLP import batch
+from NLP.batch import process_many
+from NLP.parser import preprocess, process, init_parser, ParserRegistry, ParseBudget, ParseStats, iter_parses, \
+    segment_tokens
+from NLP.grammar import VALID_VOCABULARY
+from NLP.grammar_cache import grammar_text_key
+from NLP import lemmatizer
+from NLP.lemmatizer import FuzzyIndex, find_best_match, forget_lemmas, lemmatize_word, preload_lemmas
+from NLP.template_cache import TemplateCache
+from NLP.utils import TreeIndex, find_subtree
+from NLP.value_recognizer import ValueAutomaton, ValueRecognizer, get_value_recognizer
+from NLP.vocabulary import get_vocabulary
+from data.connection_pool import POOL_SIZE, ConnectionPool
+from data.database import DB_PATH, fetch_results, stream_query
+from data.db_utils import get_available_dbs
+from data.query_budget import QueryBudget, QueryTooExpensive
+from data.metrics import PARSE_FAILURES, REGISTRY, STAGE_SECONDS, track_request
+from data.loader import build_fts_index, create_filter_indexes, load_csv
+from data.schema_catalog import SchemaCatalog
+from data.slow_log import SlowQueryLog, explain_query_plan
 
 TEST_TABLE = "movies"
 parser = init_parser()
@@ -277,6 +303,658 @@ class Tests(unittest.TestCase):
         print("--------------\n")
         self.assertEqual(total, len(LIMIT_SENTENCES))
 
+    def test_schema_catalog_cache(self):
+        """
+        Test to make sure that the schema catalog reuses its entry until
+        the schema of the database changes
+        """
+        catalog = SchemaCatalog()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.db")
+            con = sqlite3.connect(path)
+            con.execute("CREATE TABLE movies(name TEXT, year INTEGER)")
+            con.commit()
+
+            entry = catalog.get(path)
+            self.assertIs(catalog.get(path), entry)
+            self.assertEqual(entry.tables, {"movies": ("name", "year")})
+            self.assertEqual(entry.types["movies"]["year"], "INTEGER")
+
+            # Changing only the data keeps the schema
+            con.execute("INSERT INTO movies VALUES ('Shrek', 2001)")
+            con.commit()
+            self.assertIs(catalog.get(path), entry)
+
+            con.execute("CREATE TABLE shows(title TEXT)")
+            con.commit()
+            con.close()
+            self.assertEqual(catalog.get(path).tables["shows"], ("title",))
+
+    def test_parser_registry(self):
+        """
+        Test to make sure that the parser registry reuses parsers per table
+        and evicts the least recently used one
+        """
+        registry = ParserRegistry(max_size=1)
+        movies_parser = registry.get(table=TEST_TABLE)
+        self.assertIs(registry.get(table=TEST_TABLE), movies_parser)
+
+        query = process("show me the name of movies", movies_parser, TEST_TABLE)
+        self.assertEqual(query, f"SELECT name FROM {TEST_TABLE};")
+
+        registry.get()
+        self.assertEqual(len(registry), 1)
+        self.assertIsNot(registry.get(table=TEST_TABLE), movies_parser)
+
+    def test_first_parse_mode(self):
+        """
+        Test to make sure that stopping at the first complete parse gives
+        the same tree as building the whole chart
+        """
+        for sentence in list(WHERE_SENTENCES) + list(ORDER_BY_SENTENCES):
+            tokens = preprocess(sentence, table=TEST_TABLE)[0]
+            all_stats = ParseStats()
+            first_stats = ParseStats()
+
+            full_tree = next(iter_parses(parser, tokens, "all", all_stats))
+            first_tree = next(iter_parses(parser, tokens, "first", first_stats))
+
+            self.assertEqual(first_tree, full_tree)
+            self.assertTrue(first_stats.stopped_early)
+            self.assertLessEqual(first_stats.edges, all_stats.edges)
+            self.assertEqual(first_stats.trees, 1)
+
+    def test_segments_parse_mode(self):
+        """
+        Test to make sure that parsing a sentence clause by clause gives
+        the same query as parsing it whole, allows more than two filters
+        and that parsing stops cleanly once its budget runs out
+        """
+        tokens = preprocess("show name of movies where year is 2008 sorted by year", table=TEST_TABLE)[0]
+        self.assertEqual([symbol for symbol, _ in segment_tokens(tokens)], ["Head", "FilterStatement", "OrderClause"])
+
+        for sentence in list(WHERE_SENTENCES) + list(ORDER_BY_SENTENCES) + list(LIMIT_SENTENCES):
+            self.assertEqual(process(sentence, parser, TEST_TABLE, parse_mode="segments", parameterize=True),
+                             process(sentence, parser, TEST_TABLE, parse_mode="first", parameterize=True))
+
+        sentence = "show name of movies where year is 2008 and genre is 'drama' or rating is 9"
+        self.assertEqual(process(sentence, parser, TEST_TABLE, parse_mode="segments", parameterize=True),
+                         (f"SELECT name FROM {TEST_TABLE} WHERE year = ? AND LOWER(genre) = ? OR rating = ?;",
+                          (2008, "drama", 9)))
+
+        stats = ParseStats()
+        templates = TemplateCache()
+        self.assertEqual(process(sentence, parser, TEST_TABLE, parse_mode="segments", stats=stats,
+                                 templates=templates, parse_budget=ParseBudget(max_edges=20)), "")
+        self.assertTrue(stats.budget_exceeded)
+        self.assertEqual(len(templates), 0)
+
+        # A sentence only "segments" mode can parse isn't answered by a failure cached in "first" mode
+        self.assertEqual(process(sentence, parser, TEST_TABLE, parse_mode="first", templates=templates,
+                                 parameterize=True), ("", ()))
+        self.assertEqual(process(sentence, parser, TEST_TABLE, parse_mode="segments", templates=templates,
+                                 parameterize=True)[1], (2008, "drama", 9))
+
+    def test_fuzzy_index(self):
+        """
+        Test to make sure that the fuzzy index finds the same matches
+        as scanning the whole vocabulary
+        """
+        vocab = [word for words in VALID_VOCABULARY.values() for word in words]
+        vocab += ["name", "year", "genre", "director", "rating", "runtime", "movies"]
+        index = FuzzyIndex(vocab)
+
+        words = ["shw", "lst", "nam", "gere", "directors", "movie", "ordred", "x", "everythng"]
+        expected = [find_best_match(word, vocab) for word in words]
+        self.assertEqual(index.best_matches(words), expected)
+        self.assertEqual(index.best_match("gere"), "genre")
+
+    def test_preloaded_lemmas(self):
+        """
+        Test to make sure that precomputed lemmas are used instead of WordNet
+        """
+        self.addCleanup(forget_lemmas, ["__moviez__"])
+        preload_lemmas(["__moviez__"], {"__moviez__": "__movie__"})
+        self.assertEqual(lemmatize_word("__moviez__"), "__movie__")
+
+        # The table is bounded, the least recently preloaded words are dropped first
+        with mock.patch.dict(lemmatizer._lemma_table, clear=True), mock.patch("NLP.lemmatizer.LEMMA_TABLE_SIZE", 2):
+            preload_lemmas(["__word0__", "__word1__"], {"__word0__": "a", "__word1__": "b"})
+            preload_lemmas(["__word0__", "__word2__"], {"__word2__": "c"})
+            self.assertEqual(list(lemmatizer._lemma_table), ["__word0__", "__word2__"])
+        self.assertNotIn("__word2__", lemmatizer._lemma_table)
+
+    def test_vocabulary_shared(self):
+        """
+        Test to make sure that preprocessing reuses one immutable vocabulary
+        and leaves the grammar vocabulary untouched
+        """
+        table_words = list(VALID_VOCABULARY.get("Table", []))
+        first_vocab = preprocess("show me the name of movies", table=TEST_TABLE)[2]
+        second_vocab = preprocess("list the director and genre", table=TEST_TABLE)[2]
+
+        self.assertIs(first_vocab, second_vocab)
+        self.assertIs(first_vocab, get_vocabulary(table=TEST_TABLE))
+        self.assertEqual(first_vocab["Table"], (TEST_TABLE, "table", "data"))
+        self.assertEqual(VALID_VOCABULARY.get("Table", []), table_words)
+        with self.assertRaises(AttributeError):
+            first_vocab.known_words = frozenset()
+
+    def test_template_cache(self):
+        """
+        Test to make sure that sentences with the same shape share a template
+        and that templates survive in the on-disk store
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "templates.sqlite")
+            templates = TemplateCache(path=path)
+
+            for sentence, expected_query in WHERE_SENTENCES.items():
+                self.assertEqual(process(sentence, parser, TEST_TABLE, templates=templates), expected_query)
+
+            query = process("show me movies where director is \"Steven Spielberg\" and year is 1993",
+                            parser, TEST_TABLE, templates=templates)
+            self.assertEqual(query, f"SELECT * FROM {TEST_TABLE} WHERE LOWER(director) = 'steven spielberg' AND year = 1993;")
+            self.assertEqual(templates.hits, 2)
+            templates.close()
+
+            reopened = TemplateCache(path=path)
+            query = process("show me all of movies where the year is 1999", parser, TEST_TABLE, templates=reopened)
+            self.assertEqual(query, f"SELECT * FROM {TEST_TABLE} WHERE year = 1999;")
+            self.assertEqual(reopened.hits, 1)
+
+            # A forked worker opens its own connection and shares the templates through the file
+            if hasattr(os, "fork"):
+                inherited = reopened._connection()
+                key = reopened.make_key(["__child__"], TEST_TABLE, "", parser, 0, 0)
+                pid = os.fork()
+                if pid == 0:
+                    ok = reopened.get(key) is None
+                    reopened.put(key, "SELECT 1;")
+                    os._exit(0 if ok and reopened._con is not inherited else 1)
+                _, status = os.waitpid(pid, 0)
+                self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+                self.assertIs(reopened._connection(), inherited)
+                self.assertEqual(reopened.get(key), "SELECT 1;")
+            reopened.close()
+
+    def test_parameterized_query(self):
+        """
+        Test to make sure that values and numbers can be returned as
+        parameters instead of being put into the SQL
+        """
+        sentence = "show me movies where director is \"Christopher Nolan\" and year is 2010"
+        expected = (f"SELECT * FROM {TEST_TABLE} WHERE LOWER(director) = ? AND year = ?;", ("christopher nolan", 2010))
+        self.assertEqual(process(sentence, parser, TEST_TABLE, parameterize=True), expected)
+
+        templates = TemplateCache()
+        for _ in range(2):
+            query = process("show me the top 2 movies where genre is 'Action'", parser, TEST_TABLE,
+                            templates=templates, parameterize=True)
+            self.assertEqual(query, (f"SELECT * FROM {TEST_TABLE} WHERE LOWER(genre) = ? LIMIT ?;", ("action", 2)))
+        self.assertEqual(templates.hits, 1)
+
+        self.assertEqual(process("i eat", parser, TEST_TABLE, parameterize=True), ("", ()))
+
+    def test_unknown_table(self):
+        """
+        Test to make sure that a selected table the database doesn't have
+        is ignored instead of being put into the SQL
+        """
+        expected = f"SELECT * FROM {TEST_TABLE};"
+        for table in ["nosuch", f"{TEST_TABLE} UNION SELECT name, sql, 1, 1, 1, 1, 1 FROM sqlite_master --"]:
+            self.assertEqual(process("show me the movies", parser, table), expected)
+            self.assertEqual(process("show me the movies", parser, table, parameterize=True,
+                                     templates=TemplateCache()), (expected, ()))
+
+    def test_connection_pool(self):
+        """
+        Test to make sure that pooled connections are reused and read-only
+        """
+        pool = ConnectionPool("data/test_movies.db", size=2)
+        for _ in range(3):
+            with pool.connection() as con:
+                self.assertGreater(con.execute("SELECT COUNT(*) FROM movies").fetchone()[0], 0)
+                with self.assertRaises(sqlite3.OperationalError):
+                    con.execute("DELETE FROM movies")
+
+        self.assertEqual(pool.stats()["opened"], 1)
+        self.assertEqual(pool.stats()["reused"], 2)
+        pool.close()
+
+    def test_stream_query(self):
+        """
+        Test to make sure that streamed results are read in batches
+        and cut off at the row cap
+        """
+        chunks = list(stream_query(f"SELECT name, year FROM {TEST_TABLE}", fmt="json", batch_size=4, max_rows=10))
+        result = json.loads("".join(chunks))
+
+        self.assertEqual(result["columns"], ["name", "year"])
+        self.assertEqual(len(result["rows"]), 10)
+        self.assertEqual(result["row_count"], 10)
+        self.assertTrue(result["truncated"])
+        self.assertGreater(len(chunks), 3)
+
+        result = json.loads("".join(stream_query(f"SELECT name FROM {TEST_TABLE} WHERE year = ?", params=(2008,), fmt="json")))
+        self.assertEqual(result["rows"], [["The Dark Knight"]])
+        self.assertFalse(result["truncated"])
+
+        # Streams that clients are slow to read don't keep other queries waiting for the pool
+        streams = [stream_query(f"SELECT name FROM {TEST_TABLE}", fmt="json", batch_size=1) for _ in range(POOL_SIZE)]
+        self.addCleanup(lambda: [stream.close() for stream in streams])
+        for stream in streams:
+            next(stream)
+            next(stream)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fetch_results(f"SELECT COUNT(*) FROM {TEST_TABLE}")),
+                                  daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(len(results), 1)
+
+    def test_query_budget(self):
+        """
+        Test to make sure that queries are stopped once they run out of
+        time or get cancelled, keeping the rows found so far
+        """
+        endless = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT x FROM c"
+
+        with self.assertRaises(QueryTooExpensive) as raised:
+            fetch_results(endless + " WHERE x < 0", budget=QueryBudget(time_limit=0.2))
+        self.assertEqual(raised.exception.reason, "time")
+
+        with self.assertRaises(QueryTooExpensive) as raised:
+            fetch_results(endless + " WHERE x < 0", budget=QueryBudget(time_limit=None, is_cancelled=lambda: True))
+        self.assertEqual(raised.exception.reason, "cancelled")
+
+        result = fetch_results(endless + " WHERE x % 1000 = 0", budget=QueryBudget(time_limit=0.2, row_limit=None))
+        self.assertEqual(result.interrupted, "time")
+        self.assertTrue(result.truncated)
+        self.assertGreater(len(result), 0)
+
+        result = fetch_results(f"SELECT name FROM {TEST_TABLE}", budget=QueryBudget(row_limit=5))
+        self.assertEqual((len(result), result.truncated, result.interrupted), (5, True, None))
+
+        streamed = json.loads("".join(stream_query(endless + " WHERE x < 0", fmt="json",
+                                                   budget=QueryBudget(time_limit=0.2))))
+        self.assertEqual((streamed["rows"], streamed["interrupted"]), ([], "time"))
+
+    def test_metrics(self):
+        """
+        Test to make sure that requests record their stage timings and
+        that parse failures are counted and exposed
+        """
+        failures = PARSE_FAILURES.value("no_parse")
+        parsed = STAGE_SECONDS.count("parse")
+
+        with track_request("test") as metrics:
+            process("show me the name of movies", parser, TEST_TABLE)
+        self.assertEqual(set(metrics.stages), {"tokenize", "lemmatize", "resolve", "parse", "translate"})
+        self.assertEqual(metrics.info["sql"], f"SELECT name FROM {TEST_TABLE};")
+        self.assertEqual(STAGE_SECONDS.count("parse"), parsed + 1)
+
+        process("me show movies", parser, TEST_TABLE)
+        self.assertEqual(PARSE_FAILURES.value("no_parse"), failures + 1)
+
+        text = REGISTRY.render()
+        self.assertIn('naturalsql_stage_seconds_bucket{stage="parse",le="+Inf"}', text)
+        self.assertIn('naturalsql_request_seconds_count{endpoint="test"}', text)
+        self.assertIn("# TYPE naturalsql_parse_failures_total counter", text)
+
+    def test_tree_index(self):
+        """
+        Test to make sure that the tree index finds the same subtrees
+        as walking the tree does
+        """
+        for sentence in GOOD_SENTENCES:
+            tree = next(iter_parses(parser, preprocess(sentence)[0]))
+            index = TreeIndex(tree)
+            self.assertEqual(len(index.nodes), len(list(tree.subtrees())))
+
+            for node in tree.subtrees():
+                for label in ("S", "DetCol", "Col", "ColList", "FilterClause", "NumPlaceholder", "Missing"):
+                    self.assertIs(index.find(label, node), find_subtree(node, label))
+                    self.assertEqual(index.find_all(label, node),
+                                     [sub for sub in node.subtrees() if sub.label() == label])
+
+    def test_grammar_cache(self):
+        """
+        Test to make sure that compiled parsers are stored on disk and
+        loaded back with the same grammar
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            built = init_parser(cache_dir=tmp)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            loaded = init_parser(cache_dir=tmp)
+            self.assertIsNot(loaded, built)
+            self.assertEqual(loaded.grammar().productions(), built.grammar().productions())
+            self.assertEqual(grammar_text_key("S -> A"), grammar_text_key("S -> A"))
+            self.assertNotEqual(grammar_text_key("S -> A"), grammar_text_key("S -> B"))
+
+            tokens = preprocess("show me the name of movies")[0]
+            self.assertEqual(next(iter_parses(loaded, tokens)), next(iter_parses(built, tokens)))
+
+            with open(os.path.join(tmp, os.listdir(tmp)[0]), "wb") as f:
+                f.write(b"not a pickle")
+            self.assertEqual(init_parser(cache_dir=tmp).grammar().productions(), built.grammar().productions())
+
+    def test_slow_log(self):
+        """
+        Test to make sure that slow requests are written to the slow-query
+        log with their stage timings and query plan, and fast ones are not
+        """
+        with track_request("test") as metrics:
+            process("show me the name of movies where year is 2008", parser, TEST_TABLE, parameterize=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "slow", "queries.jsonl")
+            slow_log = SlowQueryLog(path, threshold=metrics.seconds + 1)
+            self.assertFalse(slow_log.check(metrics, DB_PATH))
+
+            slow_log.threshold = 0
+            self.assertTrue(slow_log.check(metrics, DB_PATH))
+            slow_log.close()
+
+            with open(path) as f:
+                entries = [json.loads(line) for line in f]
+
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry["sentence"], "show me the name of movies where year is 2008")
+        self.assertEqual(entry["sql"], f"SELECT name FROM {TEST_TABLE} WHERE year = ?;")
+        self.assertIn("parse", entry["stages"])
+        self.assertEqual(entry["plan"], explain_query_plan(entry["sql"], DB_PATH, entry["params"]))
+        self.assertTrue(entry["full_scan"])
+
+    def test_query_result(self):
+        """
+        Test to make sure that query results render without pandas
+        """
+        result = fetch_results(f"SELECT name, year FROM {TEST_TABLE} WHERE year = ?", params=(2008,))
+
+        self.assertEqual(result.columns, ["name", "year"])
+        self.assertEqual(result.rows, [("The Dark Knight", 2008)])
+        self.assertIn("<td>The Dark Knight</td>", result.to_html())
+        self.assertEqual(result.to_string().splitlines()[1], "The Dark Knight 2008")
+        self.assertEqual(json.loads(result.to_json())["rows"], [["The Dark Knight", 2008]])
+
+    def test_load_csv(self):
+        """
+        Test to make sure that the CSV loader infers column types, loads
+        every row in batches and builds the requested indexes
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "loaded.db")
+            stats = load_csv("data/input/movies.csv", TEST_TABLE, db_path, batch_size=7, index_columns=["year"])
+            self.assertEqual(stats["rows"], 30)
+
+            con = sqlite3.connect(db_path)
+            types = {row[1]: row[2] for row in con.execute(f"PRAGMA table_info({TEST_TABLE})")}
+            self.assertEqual(types, {"name": "TEXT", "year": "INTEGER", "genre": "TEXT",
+                                     "director": "TEXT", "rating": "REAL", "runtime": "REAL"})
+            self.assertEqual(con.execute(f"SELECT COUNT(*) FROM {TEST_TABLE}").fetchone()[0], 30)
+            indexes = [row[1] for row in con.execute(f"PRAGMA index_list({TEST_TABLE})")]
+            self.assertIn(f"idx_{TEST_TABLE}_year", indexes)
+            con.close()
+
+            # NOT NULL columns keep their constraint and a WAL database stays in WAL mode
+            db_path = os.path.join(tmp, "wal.db")
+            con = sqlite3.connect(db_path)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.close()
+            load_csv("data/input/movies.csv", TEST_TABLE, db_path, not_null=["name"])
+
+            con = sqlite3.connect(db_path)
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            not_null = {row[1]: row[3] for row in con.execute(f"PRAGMA table_info({TEST_TABLE})")}
+            self.assertEqual(not_null["name"], 1)
+            self.assertEqual(not_null["year"], 0)
+            con.close()
+
+    def test_index_friendly_filters(self):
+        """
+        Test to make sure that text filters match the indexes built by the loader
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "indexed.db")
+            load_csv("data/input/movies.csv", TEST_TABLE, db_path, filter_columns=["director"])
+            create_filter_indexes(db_path, TEST_TABLE, ["genre"], mode="nocase")
+
+            indexed_parser = init_parser(db_path, TEST_TABLE)
+            sentence = "show me movies where director is \"Christopher Nolan\" or genre is 'Action'"
+            query, params = process(sentence, indexed_parser, TEST_TABLE, db_path, parameterize=True)
+            self.assertEqual(query, f"SELECT * FROM {TEST_TABLE} WHERE LOWER(director) = ? OR genre = ? COLLATE NOCASE;")
+
+            con = sqlite3.connect(db_path)
+            for column, index in [("LOWER(director) = ?", "idx_movies_director_lower"),
+                                  ("genre = ? COLLATE NOCASE", "idx_movies_genre_nocase")]:
+                plan = con.execute(f"EXPLAIN QUERY PLAN SELECT * FROM {TEST_TABLE} WHERE {column}", ("x",)).fetchall()
+                self.assertIn(index, plan[0][3])
+            con.close()
+
+    def test_fts_contains_filter(self):
+        """
+        Test to make sure that "containing" filters use the full-text index
+        when there is one and LIKE when there isn't
+        """
+        sentence = "show me the name of movies where name containing \"knight\""
+        self.assertEqual(process(sentence, parser, TEST_TABLE),
+                         f"SELECT name FROM {TEST_TABLE} WHERE name LIKE '%knight%';")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "fts.db")
+            load_csv("data/input/movies.csv", TEST_TABLE, db_path)
+            build_fts_index(db_path, TEST_TABLE, ["name", "director"])
+
+            self.assertEqual(get_vocabulary(db_path, TEST_TABLE)["Table"], (TEST_TABLE, "table", "data"))
+            fts_parser = init_parser(db_path, TEST_TABLE)
+            query, params = process(sentence, fts_parser, TEST_TABLE, db_path, parameterize=True)
+            self.assertEqual(query, f"SELECT name FROM {TEST_TABLE} WHERE rowid IN (SELECT rowid FROM "
+                                    f"{TEST_TABLE}_fts WHERE {TEST_TABLE}_fts MATCH "
+                                    f"'name : \"' || replace(?, '\"', '\"\"') || '\"');")
+            self.assertEqual(params, ("knight",))
+
+            names = [row[0] for row in fetch_results(query, db_path, params)]
+            like_names = [row[0] for row in fetch_results(f"SELECT name FROM {TEST_TABLE} WHERE name LIKE '%knight%'", db_path)]
+            self.assertTrue(names)
+            self.assertEqual(names, like_names)
+
+            # Templates are shared by sentences with other values, which must reach the query whole
+            templates = TemplateCache()
+            for word in ("knight", "dark"):
+                other = sentence.replace("knight", word)
+                query, params = process(other, fts_parser, TEST_TABLE, db_path, templates=templates,
+                                        parameterize=True)
+                self.assertEqual(params, (word,))
+                names = [row[0] for row in fetch_results(query, db_path, params)]
+                self.assertTrue(names)
+                self.assertTrue(all(word in name.lower() for name in names))
+            self.assertEqual(templates.hits, 1)
+
+            # Reloading the table in another order must not leave an index pointing at the old rows
+            csv_path = os.path.join(tmp, "reordered.csv")
+            with open("data/input/movies.csv", newline="") as file:
+                lines = file.readlines()
+            with open(csv_path, "w", newline="") as file:
+                file.writelines(lines[:1] + lines[:0:-1])
+
+            load_csv(csv_path, TEST_TABLE, db_path)
+            query, params = process(sentence, init_parser(db_path, TEST_TABLE), TEST_TABLE, db_path,
+                                    parameterize=True)
+            self.assertEqual(query, f"SELECT name FROM {TEST_TABLE} WHERE name LIKE '%' || ? || '%';")
+            self.assertEqual(sorted(row[0] for row in fetch_results(query, db_path, params)), sorted(like_names))
+
+            load_csv(csv_path, TEST_TABLE, db_path, fts_columns=["name"])
+            query, params = process(sentence, init_parser(db_path, TEST_TABLE), TEST_TABLE, db_path,
+                                    parameterize=True)
+            self.assertIn(f"{TEST_TABLE}_fts MATCH", query)
+            self.assertEqual(sorted(row[0] for row in fetch_results(query, db_path, params)), sorted(like_names))
+
+        templates = TemplateCache()
+        for word in ("knight", "dark"):
+            other = sentence.replace("knight", word)
+            query, params = process(other, parser, TEST_TABLE, templates=templates, parameterize=True)
+            self.assertEqual((query, params), (f"SELECT name FROM {TEST_TABLE} WHERE name LIKE '%' || ? || '%';",
+                                               (word,)))
+            names = [row[0] for row in fetch_results(query, params=params)]
+            self.assertTrue(names)
+            self.assertLess(len(names), len(fetch_results(f"SELECT name FROM {TEST_TABLE}").rows))
+            self.assertEqual(process(other, parser, TEST_TABLE, templates=templates),
+                             f"SELECT name FROM {TEST_TABLE} WHERE name LIKE '%{word}%';")
+
+    def test_value_recognizer(self):
+        """
+        Test to make sure that values written without quotes are recognised
+        and give the same query as the quoted sentence
+        """
+        recognizer = get_value_recognizer(table=TEST_TABLE)
+        recognizer.refresh(wait=True)
+        spans = recognizer.find("show me christopher nolan movies that are action")
+        self.assertEqual([(span.value, span.columns) for span in spans],
+                         [("Christopher Nolan", ((TEST_TABLE, "director"),)), ("Action", ((TEST_TABLE, "genre"),))])
+
+        unquoted = "show me movies where director is Christopher Nolan and year is 2010"
+        quoted = "show me movies where director is \"Christopher Nolan\" and year is 2010"
+        self.assertEqual(process(unquoted, parser, TEST_TABLE, recognizer=recognizer),
+                         process(quoted, parser, TEST_TABLE))
+
+        automaton = ValueAutomaton()
+        automaton.sync_column(("t", "c"), ["New York", "York", "Paris"])
+        self.assertEqual([span.value for span in automaton.find("from new york to paris")], ["New York", "Paris"])
+        self.assertEqual(automaton.sync_column(("t", "c"), ["York", "Berlin"]), (1, 2))
+        self.assertEqual([span.value for span in automaton.find("from new york to berlin")], ["York", "Berlin"])
+        self.assertEqual(len(automaton), 2)
+
+        # Changes to the data are synced on a copy that replaces the automaton in use
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "values.db")
+            load_csv("data/input/movies.csv", TEST_TABLE, db_path)
+            recognizer = ValueRecognizer(db_path, TEST_TABLE, [(TEST_TABLE, "director")], refresh_interval=0)
+
+            # The first build doesn't hold up the request that starts it
+            release = threading.Event()
+            link = ValueAutomaton.link
+
+            def held_link(automaton):
+                release.wait(10)
+                link(automaton)
+
+            with mock.patch.object(ValueAutomaton, "link", held_link):
+                self.assertEqual(recognizer.find("show me christopher nolan movies"), [])
+                release.set()
+                for _ in range(500):
+                    if recognizer.automaton is not None:
+                        break
+                    time.sleep(0.01)
+            self.assertEqual([span.value for span in recognizer.find("show me christopher nolan movies")],
+                             ["Christopher Nolan"])
+
+            sentence = "show me greta gerwig movies"
+            self.assertEqual(recognizer.find(sentence), [])
+            in_use = recognizer.automaton
+
+            con = sqlite3.connect(db_path)
+            con.execute(f"INSERT INTO {TEST_TABLE} (name, director) VALUES ('Barbie', 'Greta Gerwig')")
+            con.commit()
+            con.close()
+
+            recognizer.refresh()
+            for _ in range(500):
+                if recognizer.automaton is not in_use:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(in_use.find(sentence), [])
+            self.assertEqual([span.value for span in recognizer.find(sentence)], ["Greta Gerwig"])
+            self.assertEqual(recognizer.automaton.lookup("christopher nolan"), in_use.lookup("christopher nolan"))
+
+    def test_process_many(self):
+        """
+        Test to make sure that batches come back in input order with
+        per-sentence errors, whether or not worker processes are used
+        """
+        sentences = ["show me the name of movies", "me show movies", "show me the name of movies"]
+        results = process_many(sentences, workers=1, table=TEST_TABLE)
+        self.assertEqual([result["sentence"] for result in results], sentences)
+        self.assertEqual(results[0]["query"], f"SELECT name FROM {TEST_TABLE};")
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1]["query"], "")
+        self.assertIsNotNone(results[1]["error"])
+
+        sentences = [f"show me all of movies where the year is {year}" for year in range(1900, 2200)]
+        in_process = process_many(sentences, workers=1, table=TEST_TABLE, parameterize=True)
+        pooled = process_many(sentences, workers=2, table=TEST_TABLE, parameterize=True)
+        self.assertEqual(pooled, in_process)
+        self.assertEqual(pooled[-1]["params"], [2199])
+
+        # Workers don't inherit locks other threads of the server hold while the pool starts
+        from NLP import vocabulary
+        results = []
+        with vocabulary._lock:
+            thread = threading.Thread(target=lambda: results.append(process_many(sentences, workers=2, table=TEST_TABLE,
+                                                                                 parameterize=True)), daemon=True)
+            thread.start()
+            thread.join(60)
+        self.assertEqual(results, [in_process])
+
+        # Batches translated in-process at the same time keep their own settings
+        from concurrent.futures import ThreadPoolExecutor
+        expected = [process_many(sentences[:50], 1, table=TEST_TABLE), in_process[:50]]
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(process_many, sentences[:50], 1, table=TEST_TABLE, parameterize=bool(idx % 2))
+                       for idx in range(8)]
+        for idx, future in enumerate(futures):
+            self.assertEqual(future.result(), expected[idx % 2])
+        self.assertEqual(batch._worker, {})
+
+    def test_ui_selection(self):
+        """
+        Test to make sure that the web UI only uses a listed database and
+        a table of that database, whether sent or kept in the session
+        """
+        from GUI.main_ui import MainGUI, app
+
+        if "batch_question" not in app.view_functions:
+            MainGUI(templates=TemplateCache())
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("data.db_utils.DB_DIR", tmp):
+            for name in ("a.db", "b.db"):
+                load_csv("data/input/movies.csv", TEST_TABLE, os.path.join(tmp, name))
+
+            client = app.test_client()
+
+            def batch_query(**data):
+                response = client.post("/batch", json={"sentences": ["show me the name"], **data})
+                self.assertEqual(response.status_code, 200)
+                return response.get_json()["results"][0]["query"]
+
+            expected = f"SELECT name FROM {TEST_TABLE};"
+            self.assertEqual(batch_query(database="a.db", table=TEST_TABLE), expected)
+            self.assertEqual(batch_query(database="a.db", table="nosuch"), "")
+            self.assertEqual(batch_query(database="a.db", table=f"{TEST_TABLE} UNION SELECT 1 --"), "")
+
+            # The table of the session is used with its own database only
+            with client.session_transaction() as sess:
+                sess["db"], sess["table"] = "a.db", TEST_TABLE
+            self.assertEqual(batch_query(database="a.db"), expected)
+            self.assertEqual(batch_query(database="b.db"), "")
+
+            response = client.post("/query", data={"database": "b.db", "user_input": ""})
+            self.assertEqual(response.status_code, 200)
+            with client.session_transaction() as sess:
+                self.assertEqual((sess["db"], sess["table"]), ("b.db", ""))
+
+            # A database that isn't listed falls back to the first one
+            for name in ("nosuch.db", "../test_movies.db"):
+                client.post("/query", data={"database": name, "table": TEST_TABLE, "user_input": ""})
+                with client.session_transaction() as sess:
+                    self.assertEqual((sess["db"], sess["table"]), (get_available_dbs()[0], TEST_TABLE))
+
+            response = client.post("/query/stream", data={"user_input": "show me the name", "table": "nosuch",
+                                                          "format": "json"})
+            self.assertEqual(response.status_code, 400)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file